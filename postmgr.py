@@ -13,65 +13,1240 @@ import re
 import os
 import fnmatch
 import gzip
+import bz2
+import lzma
+import io
+import ctypes
+import mmap
+import shutil
+import tempfile
+import zlib
 import subprocess
 import datetime
+import time
 import sys
+import json
+import pickle
+import bisect
+import hashlib
+import resource
+from array import array
+import socket
+import socketserver
+import threading
+import queue
+from collections import OrderedDict
 from multiprocessing import Pool
 
 __author__ = 'Nikolay Gatilov'
 __copyright__ = 'Nikolay Gatilov'
 __license__ = 'GPL'
-__version__ = '1.0.2017032412'
+__version__ = '1.0.2026101818'
 __maintainer__ = 'Nikolay Gatilov'
 __email__ = 'eking.work@gmail.com'
 
 
+class MultiRegex:
+    '''Match a line against the list of regular expressions in one pass.
+       All patterns are joined to one alternation - most of log lines do
+       not match any of them, so only one search is done for such lines,
+       and only for found lines every pattern is checked (literal patterns
+       as substring). If patterns can not be joined (backreferences,
+       the same group names, etc.) - every pattern is searched separately.
+       binary - match raw (bytes) lines, patterns are encoded to UTF-8
+       (\\w, \\d, \\s and ignore case are ASCII only then), patterns with
+       non-ASCII characters and regex syntax (or escapes of str patterns
+       like \\u) are searched in decoded line.
+    '''
+
+    META = set('.^$*+?{}[]\\|()')
+    BACKREF = re.compile(r'\\[1-9]|\(\?P=')
+    ANCHORS = ('^', '$', '\\A', '\\Z')
+
+    def __init__(self, patterns, binary=False):
+        self.checks = []
+        self.text = False
+        for p in patterns:
+            enc = p.encode('utf-8') if binary else p
+            reg = None
+            if self.META.isdisjoint(p):
+                self.checks.append((p, enc, None, False))
+                continue
+            if not binary or p.isascii():
+                try:
+                    reg = re.compile(enc)
+                except re.error:
+                    # escapes of str patterns only (\u, \N{...})
+                    if not binary:
+                        raise
+            if reg is not None:
+                self.checks.append((p, None, reg, False))
+            else:
+                self.checks.append((p, None, re.compile(p), True))
+                self.text = True
+        self.prefilter = None
+        if len(self.checks) > 1 and not self.text and \
+                not any(self.BACKREF.search(p) for p in patterns):
+            try:
+                self.prefilter = re.compile(
+                    '|'.join('(?:%s)' % p for p in patterns).encode('utf-8')
+                    if binary else
+                    '|'.join('(?:%s)' % p for p in patterns))
+            except re.error:
+                self.prefilter = None
+        # regex to find candidate lines in the whole buffer (see
+        # Postfix.getPostfixMLIndexAndRegexMmap), None if patterns can be
+        # checked only line by line (decoded or anchored to line)
+        self.finder = None
+        if not self.text and \
+                not any(a in p for p in patterns for a in self.ANCHORS):
+            if self.prefilter is not None:
+                self.finder = self.prefilter
+            elif len(self.checks) == 1:
+                p, literal, reg, decode = self.checks[0]
+                self.finder = reg if reg is not None else \
+                    re.compile(re.escape(literal))
+
+    def match(self, line):
+        '''Return list of patterns found in the line'''
+        if self.prefilter is not None and not self.prefilter.search(line):
+            return []
+        found = []
+        text = None
+        for p, literal, reg, decode in self.checks:
+            if literal is not None:
+                if literal in line:
+                    found.append(p)
+            elif decode:
+                if text is None:
+                    text = line.decode('utf-8', 'replace')
+                if reg.search(text):
+                    found.append(p)
+            elif reg.search(line):
+                found.append(p)
+        return found
+
+
+class QueueFilter:
+    '''Filter of mail queue records, compiled once from expression like
+       size>=1m and (domain=example.com or reason~"timed out") and not flag=!
+       Predicates are FIELD OP VALUE, joined by and/or/not and brackets:
+       size - message size, suffixes k/m/g, ops = != < <= > >=
+       age - seconds from arrival time, suffixes s/m/h/d, ops as size
+       time - arrival time '%Y-%m-%d %H:%M:%S' (quoted), ops as size
+       size=A..B, age=A..B - range, A and B are included
+       from, to, domain, message (reason) - sender, any of recipients,
+       any of recipient domains, deferral reason: = != (case-insensitive),
+       ~ !~ - regex search
+       queue - queue name (active/deferred/hold/incoming/maildrop),
+       flag - * or ! (as mailq)
+       Cheap predicates are checked first.
+       mindate, maxdate, from_regex, to_regex - old style filters, joined
+       with expression by 'and'.
+    '''
+
+    TOKEN = re.compile(r'\s*(?:(\()|(\))|(and|or|not)(?=[\s(])|'
+                       r'(\w+)\s*(!=|!~|<=|>=|=|<|>|~)\s*'
+                       r'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|[^\s()]+))',
+                       re.I)
+    COST = {'size': 1, 'age': 1, 'time': 1, 'queue': 1, 'flag': 1,
+            'from': 2, 'domain': 3, 'to': 3, 'message': 4, 'reason': 4}
+    UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3,
+             's': 1, 'h': 3600, 'd': 86400}
+    FLAGS = {'*': 'active', '!': 'hold'}
+
+    def __init__(self,
+                 expr=None,
+                 mindate=None,
+                 maxdate=None,
+                 from_regex=None,
+                 to_regex=None):
+        self.now = datetime.datetime.now()
+        nodes = []
+        if mindate is not None:
+            nodes.append((1, lambda r: 'time' in r and r['time'] >= mindate))
+        if maxdate is not None:
+            nodes.append((1, lambda r: 'time' in r and r['time'] <= maxdate))
+        if from_regex is not None:
+            frc = re.compile(from_regex)
+            nodes.append((5, lambda r: 'from' in r and
+                          frc.match(r['from']) is not None))
+        if to_regex is not None:
+            trc = re.compile(to_regex)
+            nodes.append((6, lambda r: any(trc.match(i)
+                                           for i in r.get('to', []))))
+        if expr is not None and expr.strip() != '':
+            self.tokens = self.tokenize(expr)
+            self.pos = 0
+            nodes.append(self.parseOr())
+            if self.pos != len(self.tokens):
+                raise ValueError('Unexpected "%s" in filter' %
+                                 self.tokens[self.pos][1])
+        if nodes:
+            self.check = self.join(nodes, True)[1]
+        else:
+            self.check = lambda r: True
+
+    def __call__(self, rec):
+        return self.check(rec)
+
+    def tokenize(self, expr):
+        tokens = []
+        pos = 0
+        expr = expr.rstrip()
+        while pos < len(expr):
+            m = self.TOKEN.match(expr, pos)
+            if m is None:
+                raise ValueError('Can not parse filter at "%s"' %
+                                 expr[pos:].strip())
+            if m.group(1) or m.group(2):
+                tokens.append((m.group(1) or m.group(2), m.group(0).strip()))
+            elif m.group(3):
+                tokens.append((m.group(3).lower(), m.group(3)))
+            else:
+                value = m.group(6)
+                if value[0] in '"\'':
+                    value = re.sub(r'\\(.)', r'\1', value[1:-1])
+                tokens.append(('pred', (m.group(4).lower(), m.group(5),
+                                        value)))
+            pos = m.end()
+        return tokens
+
+    def next(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][0]
+        return None
+
+    def parseOr(self):
+        nodes = [self.parseAnd()]
+        while self.next() == 'or':
+            self.pos += 1
+            nodes.append(self.parseAnd())
+        return self.join(nodes, False)
+
+    def parseAnd(self):
+        nodes = [self.parseNot()]
+        while self.next() == 'and':
+            self.pos += 1
+            nodes.append(self.parseNot())
+        return self.join(nodes, True)
+
+    def parseNot(self):
+        t = self.next()
+        if t == 'not':
+            self.pos += 1
+            cost, f = self.parseNot()
+            return (cost, lambda r: not f(r))
+        if t == '(':
+            self.pos += 1
+            node = self.parseOr()
+            if self.next() != ')':
+                raise ValueError('Expected ")" in filter')
+            self.pos += 1
+            return node
+        if t == 'pred':
+            self.pos += 1
+            return self.predicate(*self.tokens[self.pos - 1][1])
+        raise ValueError('Expected predicate in filter')
+
+    def join(self, nodes, all_of):
+        '''Join nodes (cost, function) by and (all_of) / or,
+           the cheapest are called first'''
+        nodes = sorted(nodes, key=lambda n: n[0])
+        cost, f = nodes[0]
+        for c, g in nodes[1:]:
+            if all_of:
+                f = (lambda a, b: lambda r: a(r) and b(r))(f, g)
+            else:
+                f = (lambda a, b: lambda r: a(r) or b(r))(f, g)
+            cost += c
+        return (cost, f)
+
+    def number(self, field, value):
+        if field == 'time':
+            return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+        value = value.lower()
+        if value[-1:] in self.UNITS.keys():
+            unit = self.UNITS[value[-1]]
+            if field == 'age' and value[-1] == 'm':
+                unit = 60
+            return float(value[:-1]) * unit
+        return float(value)
+
+    def predicate(self, field, op, value):
+        if field not in self.COST.keys():
+            raise ValueError('Unknown field "%s" in filter' % field)
+        cost = self.COST[field]
+        if field in ('size', 'age', 'time'):
+            if field == 'age':
+                now = self.now
+                get = (lambda r: (now - r['time']).total_seconds()
+                       if 'time' in r else None)
+            else:
+                get = (lambda r: r.get(field))
+            if op == '=' and '..' in value:
+                lo, hi = [self.number(field, i) for i in value.split('..')]
+                return (cost, lambda r: get(r) is not None and
+                        lo <= get(r) <= hi)
+            v = self.number(field, value)
+            cmp = {'=': lambda x: x == v, '!=': lambda x: x != v,
+                   '<': lambda x: x < v, '<=': lambda x: x <= v,
+                   '>': lambda x: x > v, '>=': lambda x: x >= v}
+            if op not in cmp.keys():
+                raise ValueError('Operator "%s" is not supported for "%s"' %
+                                 (op, field))
+            c = cmp[op]
+            return (cost, lambda r: get(r) is not None and c(get(r)))
+        if field == 'flag':
+            field = 'queue'
+            value = self.FLAGS.get(value, value)
+        if field == 'reason':
+            field = 'message'
+        if op in ('~', '!~'):
+            reg = re.compile(value)
+            match = (lambda x: reg.search(x) is not None)
+            cost += 2
+        elif op in ('=', '!='):
+            value = value.lower()
+            match = (lambda x: x.lower() == value)
+        else:
+            raise ValueError('Operator "%s" is not supported for "%s"' %
+                             (op, field))
+        if field == 'to':
+            f = (lambda r: any(match(i) for i in r.get('to', [])))
+        elif field == 'domain':
+            f = (lambda r: any(match(i.rpartition('@')[2])
+                               for i in r.get('to', [])))
+        else:
+            f = (lambda r: field in r and match(r[field]))
+        if op[0] == '!':
+            return (cost, lambda r: not f(r))
+        return (cost, f)
+
+
+# codec: (magic bytes, external decompressors (the first found is used))
+CODECS = OrderedDict([
+    ('gz', (b'\x1f\x8b', [['pigz', '-dc'], ['gzip', '-dc']])),
+    ('bz2', (b'BZh', [['pbzip2', '-dc'], ['lbzip2', '-dc'],
+                      ['bzip2', '-dc']])),
+    ('xz', (b'\xfd7zXZ\x00', [['xz', '-dc', '-T0']])),
+    ('zst', (b'\x28\xb5\x2f\xfd', [['zstd', '-dc', '-T0']])),
+])
+
+
+class PipeReader:
+    '''Read-only binary file-like object over output of external
+       decompressor, position in uncompressed data is tracked, so tell()
+       works and seek() works forward (data is skipped) and backward
+       (decompressor is started again) - as for gzip.open().
+       source - file object to feed to stdin of decompressor (by thread),
+       None - the file is in cmd.
+       At the end of output exit code of decompressor is checked: OSError
+       is raised if it failed (corrupt or truncated file), as for python
+       modules.
+    '''
+
+    def __init__(self, cmd, source=None):
+        self.cmd = cmd
+        self.source = source
+        self.proc = None
+        self.feeder = None
+        self.errors = None
+        self.pos = 0
+        self.start()
+
+    def start(self):
+        self.stop()
+        # stderr is read after exit, file is not filled up as pipe
+        self.errors = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(self.cmd,
+                                     stdin=(None if self.source is None
+                                            else subprocess.PIPE),
+                                     stdout=subprocess.PIPE,
+                                     stderr=self.errors,
+                                     bufsize=1024 * 1024)
+        if self.source is not None:
+            self.source.seek(0)
+            self.feeder = threading.Thread(target=self.feed,
+                                           args=(self.proc.stdin,),
+                                           daemon=True)
+            self.feeder.start()
+        self.pos = 0
+
+    def feed(self, pipe):
+        '''Copy source to stdin of decompressor'''
+        try:
+            while True:
+                data = self.source.read(1024 * 1024)
+                if not data:
+                    break
+                pipe.write(data)
+        except (OSError, ValueError):
+            pass
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+    def check(self):
+        '''Wait for decompressor at the end of output, raise OSError
+           if it failed'''
+        rc = self.proc.wait()
+        if rc != 0:
+            self.errors.seek(0)
+            msg = self.errors.read(4096).decode('utf-8', 'replace').strip()
+            raise OSError('%s failed with exit code %d: %s' %
+                          (' '.join(self.cmd), rc, msg))
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        self.pos += len(data)
+        if size < 0 or (size and not data):
+            self.check()
+        return data
+
+    def readline(self, size=-1):
+        line = self.proc.stdout.readline(size)
+        self.pos += len(line)
+        if not line and size != 0:
+            self.check()
+        return line
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=0):
+        if whence != 0:
+            raise ValueError('Only absolute seek is supported')
+        if pos < self.pos:
+            self.start()
+        while self.pos < pos:
+            if not self.read(min(pos - self.pos, 1024 * 1024)):
+                break
+        return self.pos
+
+    def stop(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.stdout.close()
+        self.proc.wait()
+        if self.feeder is not None:
+            self.feeder.join()
+            self.feeder = None
+        self.errors.close()
+        self.errors = None
+        self.proc = None
+
+    def close(self):
+        self.stop()
+        if self.source is not None:
+            self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TokenBucket:
+    '''Limit rate of reading: every read takes tokens (bytes), tokens
+       are added with rate (bytes per second) up to burst (0.1 second of
+       rate), reader sleeps while tokens are negative. rate 0 - no limit,
+       only count. One bucket per process and rate (see get),
+       read - number of bytes taken.
+    '''
+
+    BUCKETS = {}
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.burst = max(self.rate / 10, 65536.0)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.read = 0
+
+    @classmethod
+    def get(cls, rate):
+        '''Return bucket of this process (pool worker) with rate'''
+        key = (os.getpid(), rate)
+        if key not in cls.BUCKETS.keys():
+            cls.BUCKETS[key] = cls(rate)
+        return cls.BUCKETS[key]
+
+    def take(self, n):
+        self.read += n
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate) - n
+        self.last = now
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+class ThrottledFile(io.RawIOBase):
+    '''Raw binary file, every read takes bytes from TokenBucket,
+       it is used under io.BufferedReader (see Postfix.openFile)'''
+
+    def __init__(self, path, bucket):
+        self.f = open(path, mode='rb', buffering=0)
+        self.bucket = bucket
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        if n:
+            self.bucket.take(n)
+        return n
+
+    def seek(self, pos, whence=0):
+        return self.f.seek(pos, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+class ScanStats:
+    '''Counters of log scanning in this process (pool worker):
+       bytes - uncompressed bytes scanned, lines - lines scanned,
+       matches - lines matched by regex; see Postfix.callStats'''
+
+    COUNTERS = {'bytes': 0, 'lines': 0, 'matches': 0}
+
+    @classmethod
+    def add(cls, bytes=0, lines=0, matches=0):
+        cls.COUNTERS['bytes'] += bytes
+        cls.COUNTERS['lines'] += lines
+        cls.COUNTERS['matches'] += matches
+
+    @classmethod
+    def snapshot(cls):
+        return dict(cls.COUNTERS)
+
+
+# ioprio_set syscall numbers
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+              'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+
+
+def setPriority(nice=0, idle_io=False):
+    '''Lower CPU (os.nice) and I/O priority (idle class by ioprio_set)
+       of this process, it is inherited by pool workers and external
+       decompressors started after it, return False on error'''
+    ok = True
+    if nice:
+        try:
+            os.nice(nice)
+        except OSError as e:
+            print(str(e))
+            ok = False
+    if idle_io:
+        nr = IOPRIO_SET.get(os.uname().machine)
+        if nr is None:
+            print('ioprio_set is not supported on %s' % os.uname().machine)
+            return False
+        libc = ctypes.CDLL(None, use_errno=True)
+        # IOPRIO_WHO_PROCESS, this process, IOPRIO_CLASS_IDLE << 13
+        if libc.syscall(nr, 1, 0, 3 << 13) != 0:
+            print('ioprio_set: %s' % os.strerror(ctypes.get_errno()))
+            ok = False
+    return ok
+
+
+def idHash(mid):
+    '''Stable (the same in all processes) 64 bit hash of message ID
+       (str or bytes)'''
+    if isinstance(mid, str):
+        mid = mid.encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(mid,
+                                          digest_size=8).digest(), 'little')
+
+
+class OffsetIndex:
+    '''Compact index of log file {MsgID: [seek_pos,]}: sorted array of
+       hashes of message IDs, array of starts of their runs in array of
+       offsets (offsets of one message are sorted). It takes 16 bytes
+       per message and 8 bytes per line and is pickled as raw arrays.
+       Different IDs with the same hash share the run, so lines read
+       by offsets must be checked by message ID.
+    '''
+
+    def __init__(self, keys=None, starts=None, offsets=None):
+        self.keys = keys if keys is not None else array('Q')
+        self.starts = starts if starts is not None else array('Q', [0])
+        self.offsets = offsets if offsets is not None else array('Q')
+
+    @classmethod
+    def fromDict(cls, id_seek_d):
+        '''Create index from dict {MsgID: [seek_pos,]}'''
+        idx = cls()
+        items = sorted(((idHash(mid), offs) for mid, offs in
+                        id_seek_d.items()), key=lambda i: i[0])
+        for h, offs in items:
+            if idx.keys and idx.keys[-1] == h:
+                idx.offsets.extend(offs)
+                run = sorted(idx.offsets[idx.starts[-2]:])
+                idx.offsets[idx.starts[-2]:] = array('Q', run)
+            else:
+                idx.keys.append(h)
+                idx.offsets.extend(offs)
+                idx.starts.append(len(idx.offsets))
+            idx.starts[-1] = len(idx.offsets)
+        return idx
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, h):
+        i = bisect.bisect_left(self.keys, h)
+        if i < len(self.keys) and self.keys[i] == h:
+            return i
+        return -1
+
+    def get(self, mid):
+        '''Return array of offsets of the message (may be empty)'''
+        return self.getHash(idHash(mid))
+
+    def getHash(self, h):
+        '''Return array of offsets by hash of message ID (see idHash)'''
+        i = self.find(h)
+        if i < 0:
+            return array('Q')
+        return self.offsets[self.starts[i]:self.starts[i + 1]]
+
+    def __contains__(self, mid):
+        return self.find(idHash(mid)) >= 0
+
+    def cut(self, end):
+        '''Return index without offsets from end (the last unfinished
+           line of file is not saved in persistent index)'''
+        if not self.offsets or max(self.offsets) < end:
+            return self
+        idx = OffsetIndex()
+        for i, h in enumerate(self.keys):
+            offs = [o for o in self.offsets[self.starts[i]:
+                                            self.starts[i + 1]] if o < end]
+            if offs:
+                idx.keys.append(h)
+                idx.offsets.extend(offs)
+                idx.starts.append(len(idx.offsets))
+        return idx
+
+    def merge(self, other):
+        '''Return new index with offsets of both indexes (indexes of
+           parts of the file may be merged in any order)'''
+        if not len(other):
+            return self
+        if not len(self):
+            return other
+        idx = OffsetIndex()
+        i = 0
+        j = 0
+        while i < len(self.keys) or j < len(other.keys):
+            if j >= len(other.keys) or (i < len(self.keys) and
+                                        self.keys[i] < other.keys[j]):
+                h = self.keys[i]
+                idx.offsets.extend(self.offsets[self.starts[i]:
+                                                self.starts[i + 1]])
+                i += 1
+            elif i >= len(self.keys) or other.keys[j] < self.keys[i]:
+                h = other.keys[j]
+                idx.offsets.extend(other.offsets[other.starts[j]:
+                                                 other.starts[j + 1]])
+                j += 1
+            else:
+                h = self.keys[i]
+                a = self.offsets[self.starts[i]:self.starts[i + 1]]
+                b = other.offsets[other.starts[j]:other.starts[j + 1]]
+                if a and b and b[0] < a[-1]:
+                    a, b = b, a
+                    if b[0] < a[-1]:
+                        a = array('Q', sorted(a + b))
+                        b = array('Q')
+                idx.offsets.extend(a)
+                idx.offsets.extend(b)
+                i += 1
+                j += 1
+            idx.keys.append(h)
+            idx.starts.append(len(idx.offsets))
+        return idx
+
+
 class Postfix:
     '''Class to parse log files and postfix queue '''
 
+    # queue directories read by iterQueueDir, as showq does
+    QUEUES = ['incoming', 'active', 'deferred', 'hold', 'maildrop']
+    # digits of long queue ID (enable_long_queue_ids), the last is
+    # separator of inode number
+    LONG_ID_DIGITS = '0123456789BCDFGHJKLMNPQRSTVWXYZbcdfghjklmnpqrstvwxyz'
+
     def __init__(self,
                  mailq='mailq',
                  postsuper='postsuper',
+                 postqueue='postqueue',
+                 queue_backend='auto',
+                 queue_dir='/var/spool/postfix',
+                 delete_batch=1000,
                  log_mask='mail.info*',
                  log_dir='/var/log',
                  multiprocess=True,
-                 noindex=False):
+                 noindex=False,
+                 index_dir=None,
+                 chunk_size=256 * 1024 * 1024,
+                 gather=False,
+                 gather_limit=100000,
+                 decode_errors='replace',
+                 decompress='auto',
+                 engine='auto',
+                 cache_size=64 * 1024 * 1024,
+                 io_limit=0,
+                 stats=False,
+                 workers=None):
         '''You can set up full path to binary files and logs, default is:
            mailq='mailq', postsuper='postsuper',
            log_mask='mail.info*', log_dir='/var/log'
+           queue_backend - how to read mail queue: 'json' - postqueue -j,
+           'text' - mailq output, 'auto' - json if it is supported,
+           'dir' - read queue files from queue_dir (see iterQueueDir)
+           delete_batch - number of messages deleted by one postsuper
+           index_dir - directory for persistent log index,
+           None - do not keep index between runs
+           chunk_size - uncompressed log files bigger than this (bytes)
+           are parsed by several processes, 0 or None - one process per file
+           gather - gather lines of matched messages while compressed
+           files are parsed first time, so they are decompressed only once,
+           gather_limit - max number of not finished messages in buffer
+           decode_errors - how to decode log lines with invalid UTF-8:
+           'strict' (error), 'replace', 'ignore', 'backslashreplace',
+           'surrogateescape'; lines are matched as bytes and only found
+           lines are decoded
+           decompress - how to read compressed (gz, bz2, xz, zst - found
+           by magic bytes) files: 'internal' - python modules, 'external' -
+           only external decompressors (pigz/gzip, pbzip2/lbzip2/bzip2, xz,
+           zstd),
+           'auto' - external if it is installed, otherwise internal
+           engine - how to scan uncompressed log files: 'mmap' (or 'auto')
+           - map the file to memory and search regex in the whole buffer
+           (rotated files only: the live file is read by lines, it may be
+           truncated by logrotate copytruncate and reading of truncated
+           map kills the process by SIGBUS), 'lines' - read line by line
+           (as compressed files)
+           cache_size - max size (bytes) of cache of results in index_dir
+           (see ResultCache), 0 or None - do not cache results
+           io_limit - max rate (bytes per second) of reading log files by
+           all workers (TokenBucket per worker), 0 - no limit; files are
+           read by buffered reads then, not mmap, and compressed files
+           are fed to external decompressor by postmgr
+           stats - collect statistics of calls in workers (see getStats)
+           workers - number of processes in pool (if multiprocess),
+           None - number of CPUs; pool is created once and must be
+           closed by close() (or use Postfix as context manager)
         '''
         self.mail_reg = r'[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.*[a-zA-Z0-9-.]*|MAILER-DAEMON'
         self.log_mask = log_mask
         self.log_dir = log_dir
         self.mailq = mailq
         self.postsuper = postsuper
+        self.postqueue = postqueue
+        self.queue_backend = queue_backend
+        self.queue_dir = queue_dir
+        self.queue_cache = None
+        self.delete_batch = delete_batch
+        self.filters = {}
         self.postfixloglinereg = '.* postfix.*: (\w+): .*'
+        self.logtimereg = re.compile(r'(\w{3}\s+\d+\s+\d+:\d+:\d+)\s|'
+                                     r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d'
+                                     r'(?:\.\d+)?(?:Z|[+-]\d\d:\d\d)?)\s')
+        self.times = None
         self.multiprocess = multiprocess
         self.noindex = noindex
+        self.index_dir = index_dir
+        self.chunk_size = chunk_size
+        self.gather = gather
+        self.gather_limit = gather_limit
+        self.decode_errors = decode_errors
+        self.decompress = decompress
+        self.engine = engine
+        # live log file (see getLiveFile), it is not mapped to memory,
+        # None - not known yet
+        self.live_file = None
+        self.cache_size = cache_size
+        self.io_limit = io_limit
+        # bytes read by workers (if io_limit), see getReadBytes
+        self.read_bytes = 0
+        # seconds spent in phases of log parsing: files, index, join, lines
+        self.timings = {}
+        self.cpu_timings = {}
+        self.stats = stats
+        self.call_stats = []
+        self.workers = workers
+        self.pool = None
+
+    def __getstate__(self):
+        # instance is sent to pool workers with its methods, without pool
+        state = self.__dict__.copy()
+        state['pool'] = None
+        # compiled queue filters can not be pickled
+        state['filters'] = {}
+        # caches of the main process are not needed in workers
+        state['queue_cache'] = None
+        state['times'] = None
+        state['call_stats'] = []
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def getWorkers(self):
+        return self.workers or os.cpu_count() or 1
+
+    def getPool(self):
+        '''Return pool of workers, it is created on first use'''
+        if self.pool is None:
+            self.pool = Pool(self.getWorkers())
+        return self.pool
+
+    def close(self):
+        '''Stop pool of workers'''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def getBucket(self):
+        '''Return TokenBucket of this process'''
+        rate = self.io_limit
+        if self.multiprocess:
+            rate = float(rate) / self.getWorkers()
+        return TokenBucket.get(rate)
+
+    def getReadBytes(self):
+        '''Return number of bytes of log files read by workers and
+           this process (only if io_limit)'''
+        return self.read_bytes + self.getBucket().read
+
+    def callStats(self, func, item):
+        '''Call func(item) (in worker), return tuple (result, stats):
+           pid, func, file, wall and cpu time, decompress_cpu - cpu time
+           of external decompressors, read - bytes read (if io_limit),
+           bytes, lines, matches (see ScanStats), rss - peak RSS (bytes)
+        '''
+        bucket = self.getBucket()
+        read = bucket.read
+        counters = ScanStats.snapshot()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        res = func(item)
+        st = {'pid': os.getpid(),
+              'func': func.__name__,
+              'file': item if isinstance(item, str) else item[0],
+              'wall': time.perf_counter() - wall,
+              'cpu': time.process_time() - cpu,
+              'read': bucket.read - read}
+        ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+        st['decompress_cpu'] = ru.ru_utime + ru.ru_stime - \
+            children.ru_utime - children.ru_stime
+        for k, v in ScanStats.snapshot().items():
+            st[k] = v - counters[k]
+        st['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return (res, st)
+
+    def getStats(self):
+        '''Return statistics of the run (if stats): wall and cpu time of
+           phases (this process), sums of calls in workers (see
+           callStats) per file and per worker (pid), totals and peak RSS
+           (bytes) of this process and workers'''
+        fields = ['calls', 'wall', 'cpu', 'decompress_cpu', 'read',
+                  'bytes', 'lines', 'matches']
+        files = {}
+        workers = {}
+        totals = dict((c, 0) for c in fields)
+        for st in self.call_stats:
+            for d, k in ((files, st['file']), (workers, str(st['pid']))):
+                if k not in d.keys():
+                    d[k] = dict((c, 0) for c in fields)
+                d[k]['calls'] += 1
+                for c in fields[1:]:
+                    d[k][c] += st[c]
+            w = workers[str(st['pid'])]
+            w['rss'] = max(w.get('rss', 0), st['rss'])
+            totals['calls'] += 1
+            for c in fields[1:]:
+                totals[c] += st[c]
+        rss_workers = resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        for w in workers.values():
+            rss_workers = max(rss_workers, w['rss'])
+        phases = dict((phase, {'wall': wall,
+                               'cpu': self.cpu_timings.get(phase, 0)})
+                      for phase, wall in self.timings.items())
+        return {'phases': phases,
+                'files': files,
+                'workers': workers,
+                'totals': totals,
+                'peak_rss': {
+                    'main': resource.getrusage(
+                        resource.RUSAGE_SELF).ru_maxrss * 1024,
+                    'workers': rss_workers}}
+
+    def imap(self, func, items, ordered=False):
+        '''Call func for every item in pool of workers (in this process
+           if not multiprocess), yield tuples (item, result) as soon as
+           result is ready, in order of items if ordered.
+           Not more than 2 * workers items are in flight (sent to workers
+           or waiting to be yielded), so memory is bounded by them,
+           not by all results.
+        '''
+        items = list(items)
+        if not self.multiprocess:
+            for item in items:
+                if self.stats:
+                    res, st = self.callStats(func, item)
+                    self.call_stats.append(st)
+                    yield (item, res)
+                else:
+                    yield (item, func(item))
+            return
+        pool = self.getPool()
+        ready = queue.Queue()
+        limit = 2 * self.getWorkers()
+        results = {}
+        sent = 0
+        done = 0
+        if self.io_limit or self.stats:
+            args = (lambda item: (func, item))
+            call = self.callStats
+        else:
+            args = (lambda item: (item,))
+            call = func
+        while done < len(items):
+            while sent < len(items) and sent - done < limit:
+                pool.apply_async(call, args(items[sent]),
+                                 callback=(lambda r, n=sent:
+                                           ready.put((n, True, r))),
+                                 error_callback=(lambda e, n=sent:
+                                                 ready.put((n, False, e))))
+                sent += 1
+            while not results or (ordered and done not in results.keys()):
+                n, ok, res = ready.get()
+                if not ok:
+                    raise res
+                results[n] = res
+            n = done if ordered else next(iter(results.keys()))
+            res = results.pop(n)
+            if self.io_limit or self.stats:
+                res, st = res
+                self.read_bytes += st['read']
+                if self.stats:
+                    self.call_stats.append(st)
+            done += 1
+            yield (items[n], res)
+
+    def startTiming(self):
+        '''Return current (wall, cpu) time for addTiming'''
+        return (time.perf_counter(), time.process_time())
+
+    def addTiming(self, phase, start):
+        '''Add wall and cpu time (of this process) from start (see
+           startTiming) to the phase in timings and cpu_timings,
+           return current time'''
+        now = self.startTiming()
+        self.timings[phase] = self.timings.get(phase, 0) + now[0] - start[0]
+        self.cpu_timings[phase] = self.cpu_timings.get(phase, 0) + \
+            now[1] - start[1]
+        return now
 
     def getFiles(self):
-        '''Get list of log (rotated), may be gzipped) files '''
+        '''Get list of log (rotated), may be compressed) files '''
         matches = []
         for root, dirnames, filenames in os.walk(self.log_dir):
             for filename in fnmatch.filter(filenames, self.log_mask):
                 matches.append(os.path.join(root, filename))
         return matches
 
+    def getLiveFile(self):
+        '''Return path of the live (last modified uncompressed) log file'''
+        files = [f for f in self.getFiles() if not self.isCompressed(f)]
+        if not files:
+            return None
+        return max(files, key=os.path.getmtime)
+
+    def getCodec(self, path):
+        '''Return codec of compressed file (key of CODECS) found by
+           magic bytes or None for uncompressed file'''
+        try:
+            with open(path, mode='rb') as f:
+                magic = f.read(8)
+        except Exception:
+            return None
+        for codec, (m, cmds) in CODECS.items():
+            if magic.startswith(m):
+                return codec
+        return None
+
+    def isCompressed(self, path):
+        '''Compressed file never changes and can not be read by
+           byte ranges'''
+        return self.getCodec(path) is not None
+
+    def getDecompressor(self, codec):
+        '''Return command of installed external decompressor
+           or None'''
+        for cmd in CODECS[codec][1]:
+            if shutil.which(cmd[0]) is not None:
+                return cmd
+        return None
+
     def getFileHandler(self, path):
         '''Get opened file handler or string.io (like file)
-           argument to this function - the full path to the file'''
-        if path[-3:] == '.gz':
-            try:
-                return gzip.open(path, mode='rb')
-            except Exception as e:
-                print(str(e))
-                return None
-        else:
+           argument to this function - the full path to the file,
+           compressed file is decompressed by external decompressor
+           or python module (see decompress)'''
+        codec = self.getCodec(path)
+        try:
+            if codec is None:
+                return self.openFile(path)
+            cmd = None
+            if self.decompress != 'internal':
+                cmd = self.getDecompressor(codec)
+            if cmd is not None:
+                if self.io_limit:
+                    return PipeReader(cmd, source=self.openFile(path))
+                return PipeReader(cmd + [path])
+            if self.decompress == 'external':
+                raise OSError('There is no decompressor for %s' % path)
+            src = self.openFile(path) if self.io_limit else path
+            if codec == 'gz':
+                return gzip.open(src, mode='rb')
+            if codec == 'bz2':
+                return bz2.open(src, mode='rb')
+            if codec == 'xz':
+                return lzma.open(src, mode='rb')
             try:
-                return open(path, mode='rb')
-            except Exception as e:
-                print(str(e))
-                return None
+                import zstandard
+            except ImportError:
+                raise OSError('Install zstd or python zstandard to '
+                              'read %s' % path)
+            return zstandard.open(src, mode='rb')
+        except Exception as e:
+            print(str(e))
+            return None
+
+    def openFile(self, path):
+        '''Open uncompressed file for binary read, reads are limited
+           by io_limit'''
+        if not self.io_limit:
+            return open(path, mode='rb')
+        return io.BufferedReader(ThrottledFile(path, self.getBucket()),
+                                 buffer_size=256 * 1024)
+
+    def getFileKey(self, path):
+        '''Return tuple (device, inode, size, mtime) of the file
+           or None if file is not accessible'''
+        try:
+            st = os.stat(path)
+        except Exception as e:
+            print(str(e))
+            return None
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+    def getIndexPath(self, key):
+        '''Full path to persistent index of the file with key
+           from getFileKey - index follow the file after rotation
+           while inode is the same'''
+        return os.path.join(self.index_dir, '%d-%d.idx' % (key[0], key[1]))
+
+    def loadIndex(self, path):
+        '''Load persistent index of log file, return tuple
+           (key, indexed_size, OffsetIndex).
+           indexed_size is position after the last indexed line,
+           the file must be indexed from this position to the end.
+           Compressed files never change, so for them index is used
+           only if the key is the same; uncompressed (live) file may
+           only grow - index is used while the indexed part is not changed.
+        '''
+        key = self.getFileKey(path)
+        if key is None or self.index_dir is None:
+            return (key, 0, OffsetIndex())
+        try:
+            with open(self.getIndexPath(key), 'rb') as f:
+                idx = pickle.load(f)
+        except Exception:
+            return (key, 0, OffsetIndex())
+        if not isinstance(idx['index'], OffsetIndex):
+            return (key, 0, OffsetIndex())
+        size = self.getIndexedSize(path, key, idx['key'], idx['size'],
+                                   idx['tail'])
+        if size == 0:
+            return (key, 0, OffsetIndex())
+        return (key, size, idx['index'])
+
+    def getIndexedSize(self, path, key, stored_key, size, tail):
+        '''Check that data stored for the file (index) with stored_key
+           is valid for the file with key now, return size of indexed
+           part or 0 if the file must be indexed again, see loadIndex'''
+        if stored_key == key:
+            return size
+        if self.isCompressed(path) or stored_key is None or \
+                stored_key[:2] != key[:2] or key[2] < size:
+            return 0
+        try:
+            with open(path, mode='rb') as f:
+                f.seek(size - len(tail))
+                if f.read(len(tail)) != tail:
+                    return 0
+        except Exception:
+            return 0
+        return size
+
+    def saveIndex(self, key, size, tail, index):
+        '''Save persistent index of log file, see loadIndex'''
+        if key is None or self.index_dir is None:
+            return
+        ipath = self.getIndexPath(key)
+        tmp = '%s.%d.tmp' % (ipath, os.getpid())
+        try:
+            os.makedirs(self.index_dir, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                pickle.dump({'key': key,
+                             'size': size,
+                             'tail': tail,
+                             'index': index},
+                            f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, ipath)
+        except Exception as e:
+            print(str(e))
+
+    def cleanIndex(self, files, ext='.idx'):
+        '''Remove persistent indexes (or other files with extension ext,
+           named by file key) of files which are not exists now'''
+        if self.index_dir is None or not os.path.isdir(self.index_dir):
+            return
+        keep = set()
+        for path in files:
+            key = self.getFileKey(path)
+            if key is not None:
+                keep.add('%d-%d%s' % (key[0], key[1], ext))
+        for name in os.listdir(self.index_dir):
+            if name[-len(ext):] == ext and name not in keep:
+                try:
+                    os.remove(os.path.join(self.index_dir, name))
+                except Exception as e:
+                    print(str(e))
+
+    def getPostfixLineReg(self):
+        '''Return compiled regex of postfix log line for raw lines,
+           group 1 is message ID (bytes)'''
+        return re.compile(self.postfixloglinereg.encode('ascii'))
+
+    def getPostfixBufReg(self):
+        '''Return compiled regex of postfix log line for finditer over
+           buffer of many lines, match is the line with newline'''
+        return re.compile(b'(?m)^' + self.postfixloglinereg.encode('ascii') +
+                          b'\n?')
+
+    def useMmap(self, path):
+        '''Return True if the file is scanned in memory map
+           (empty file can not be mapped, live file may be truncated)'''
+        if self.engine == 'lines' or self.io_limit:
+            return False
+        if self.live_file is None:
+            self.live_file = self.getLiveFile() or ''
+        try:
+            return path != self.live_file and \
+                os.path.getsize(path) > 0 and not self.isCompressed(path)
+        except OSError:
+            return False
+
+    def decodeLine(self, line):
+        '''Decode raw log line by decode_errors policy'''
+        return line.decode('utf-8', self.decode_errors)
+
+    def indexFile(self, path):
+        '''Return index of log file (OffsetIndex) - from persistent
+           index, only new part of the file is parsed'''
+        key, size, index = self.loadIndex(path)
+        if key is None:
+            return index
+        if size > 0 and (self.isCompressed(path) or size == key[2]):
+            return index
+        f = self.getFileHandler(path)
+        if f is None:
+            return index
+        postfixline = self.getPostfixLineReg()
+        id_seek_d = {}
+        f.seek(size)
+        fpos = size
+        idx_end = size
+        tail = b''
+        for line in f:
+            plr = postfixline.match(line)
+            if plr:
+                PMsgID = plr.group(1)
+                if PMsgID not in id_seek_d.keys():
+                    id_seek_d[PMsgID] = array('Q')
+                id_seek_d[PMsgID].append(fpos)
+            fpos = f.tell()
+            if line[-1:] == b'\n':
+                idx_end = fpos
+                tail = line
+        f.close()
+        if fpos > size:
+            index = index.merge(OffsetIndex.fromDict(id_seek_d))
+            if idx_end > size:
+                self.saveIndex(key, idx_end, tail[-64:],
+                               index.cut(idx_end))
+        return index
+
+    def getPostfixMailLogByIndex(self, fh):
+        '''argument to this function is tuple (f, r):
+           f - full path to log file
+           r - list of the Mail ID which must be found in log
+           The same as getPostfixMailLogByID1, but read only lines
+           from persistent index.
+           return dict MsgID: list of log lines
+        '''
+        index = self.indexFile(fh[0])
+        seek_d = {}
+        for mid in fh[1]:
+            for sid in index.get(mid):
+                if sid not in seek_d.keys():
+                    seek_d[sid] = {None: []}
+                seek_d[sid][None].append(mid)
+        if seek_d == {}:
+            return {}
+        return self.getPostfixMLLines((fh[0], seek_d)).get(None, {})
 
     def getPostfixMailLogByID1(self, fh):
         '''argument to this function is tuple (f, r):
@@ -83,17 +1258,21 @@ class Postfix:
         f = self.getFileHandler(fh[0])
         if f is None:
             return None
-        postfixline = re.compile(self.postfixloglinereg)
+        postfixline = self.getPostfixLineReg()
+        ids = set(mid.encode('ascii') for mid in fh[1])
         p = {}
+        nlines = 0
+        nfound = 0
         for line in f:
-            line = line.decode('utf-8')
+            nlines += 1
             plr = postfixline.match(line)
-            if plr:
-                mid = plr.group(1)
-                if mid in fh[1]:
-                    if mid not in p.keys():
-                        p[mid] = list()
-                    p[mid].append(line)
+            if plr and plr.group(1) in ids:
+                nfound += 1
+                mid = plr.group(1).decode('ascii')
+                if mid not in p.keys():
+                    p[mid] = list()
+                p[mid].append(self.decodeLine(line))
+        ScanStats.add(bytes=f.tell(), lines=nlines, matches=nfound)
         f.close()
         return p
 
@@ -101,57 +1280,470 @@ class Postfix:
         '''Return dict (keys is MsgID) of list of strings from log file
            correspond to this message - from All log files
         '''
+        t = self.startTiming()
         MIL = []
         GF = self.getFiles()
         for f in GF:
             MIL.append((f, idlist))
-        if self.multiprocess:
-            PILL = Pool().map(self.getPostfixMailLogByID1, MIL)
+        if self.index_dir is not None:
+            self.cleanIndex(GF)
+            func = self.getPostfixMailLogByIndex
         else:
-            PILL = map(self.getPostfixMailLogByID1, MIL)
+            func = self.getPostfixMailLogByID1
+        t = self.addTiming('files', t)
         p = {}
-        for pool_res in PILL:
+        for fh, pool_res in self.imap(func, MIL, ordered=True):
             if pool_res is None:
                 continue
             for msg in pool_res.keys():
                 if msg not in p.keys():
                     p[msg] = list()
                 p[msg].extend(pool_res[msg])
+        self.addTiming('lines', t)
         return p
 
+    def getRanges(self, path):
+        '''Split big uncompressed log file to line-aligned byte ranges,
+           return list of tuples (start, end), end is None for the last
+           range - it is read up to the end of file (live file may grow).
+           Compressed or small file is one range (0, None).
+        '''
+        if not self.chunk_size or self.isCompressed(path):
+            return [(0, None)]
+        try:
+            size = os.path.getsize(path)
+            bounds = [0]
+            with open(path, mode='rb') as f:
+                pos = self.chunk_size
+                while pos < size:
+                    f.seek(pos - 1)
+                    f.readline()
+                    pos = f.tell()
+                    if pos >= size:
+                        break
+                    bounds.append(pos)
+                    pos += self.chunk_size
+        except Exception as e:
+            print(str(e))
+            return [(0, None)]
+        return list(zip(bounds, bounds[1:] + [None]))
+
+    def getLineTime(self, line, mtime):
+        '''Return time of log line (syslog or RFC 3339 format) as local
+           datetime or None, year of syslog time is taken from
+           modification time of the file (mtime as datetime)'''
+        m = self.logtimereg.match(line)
+        if m is None:
+            return None
+        try:
+            if m.group(1):
+                t = datetime.datetime.strptime('%d %s' % (mtime.year,
+                                                          m.group(1)),
+                                               '%Y %b %d %H:%M:%S')
+                if t > mtime + datetime.timedelta(days=1):
+                    t = t.replace(year=t.year - 1)
+                return t
+            t = datetime.datetime.fromisoformat(m.group(2).replace('Z',
+                                                                   '+00:00'))
+        except ValueError:
+            return None
+        if t.tzinfo is not None:
+            t = t.astimezone().replace(tzinfo=None)
+        return t
+
+    def loadTimes(self):
+        '''Cache of times of log files {dev-inode: (key, (first, last))},
+           it is kept in index_dir between runs'''
+        if self.times is None:
+            self.times = {}
+            if self.index_dir is not None:
+                try:
+                    with open(os.path.join(self.index_dir,
+                                           'times.pickle'), 'rb') as f:
+                        self.times = pickle.load(f)
+                except Exception:
+                    self.times = {}
+        return self.times
+
+    def saveTimes(self, files):
+        '''Save cache of times of log files (only for files in list)'''
+        if self.index_dir is None or self.times is None:
+            return
+        keep = {}
+        for path in files:
+            key = self.getFileKey(path)
+            if key is not None and '%d-%d' % key[:2] in self.times.keys():
+                keep['%d-%d' % key[:2]] = self.times['%d-%d' % key[:2]]
+        fname = os.path.join(self.index_dir, 'times.pickle')
+        tmp = '%s.%d.tmp' % (fname, os.getpid())
+        try:
+            os.makedirs(self.index_dir, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                pickle.dump(keep, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, fname)
+        except Exception as e:
+            print(str(e))
+
+    def setFileTimes(self, path, times):
+        '''Add times of the file to cache, see getFileTimes'''
+        key = self.getFileKey(path)
+        if key is not None and times is not None:
+            self.loadTimes()['%d-%d' % key[:2]] = (key, times)
+
+    def getFileTimes(self, path):
+        '''Return tuple (first, last) - times of the first and the last
+           line of log file or None if they are unknown. Times of
+           uncompressed file are read from its head and tail, times of
+           compressed file - from cache, it is filled while the file
+           is parsed by getPostfixMLIndexAndRegex.
+        '''
+        key = self.getFileKey(path)
+        if key is None:
+            return None
+        cache = self.loadTimes()
+        ck = '%d-%d' % key[:2]
+        if ck in cache.keys() and cache[ck][0] == key:
+            return cache[ck][1]
+        if self.isCompressed(path):
+            return None
+        mtime = datetime.datetime.fromtimestamp(key[3])
+        first = None
+        last = None
+        try:
+            with open(path, mode='rb') as f:
+                for line in f.read(65536).splitlines():
+                    first = self.getLineTime(line.decode('utf-8', 'replace'),
+                                             mtime)
+                    if first is not None:
+                        break
+                f.seek(max(0, key[2] - 65536))
+                for line in reversed(f.read().splitlines()):
+                    last = self.getLineTime(line.decode('utf-8', 'replace'),
+                                            mtime)
+                    if last is not None:
+                        break
+        except Exception as e:
+            print(str(e))
+            return None
+        if first is None or last is None:
+            return None
+        cache[ck] = (key, (first, last))
+        return (first, last)
+
+    def findTime(self, path, when, after=False):
+        '''Binary search in uncompressed log file, return position of
+           the first line with time >= when (> when if after)'''
+        mtime = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+
+        def later(t):
+            return t > when if after else t >= when
+
+        with open(path, mode='rb') as f:
+            lo = 0
+            hi = os.path.getsize(path)
+            while hi - lo > 65536:
+                mid = (lo + hi) // 2
+                f.seek(mid)
+                f.readline()
+                t = None
+                while t is None:
+                    pos = f.tell()
+                    line = f.readline()
+                    if line == b'' or pos >= hi:
+                        break
+                    t = self.getLineTime(line.decode('utf-8', 'replace'),
+                                         mtime)
+                if t is None or later(t):
+                    hi = mid
+                else:
+                    lo = pos
+            f.seek(lo)
+            if lo > 0:
+                f.seek(lo - 1)
+                f.readline()
+            while True:
+                pos = f.tell()
+                line = f.readline()
+                if line == b'':
+                    return pos
+                t = self.getLineTime(line.decode('utf-8', 'replace'), mtime)
+                if t is not None and later(t):
+                    return pos
+
+    def inWindow(self, times, since=None, until=None):
+        '''Check that all lines of the file with times (first, last)
+           are from since to until'''
+        if since is None and until is None:
+            return True
+        if times is None:
+            return False
+        return ((since is None or times[0] >= since) and
+                (until is None or times[1] <= until))
+
+    def getWindow(self, path, since=None, until=None):
+        '''Return byte range (start, end) of log file with lines
+           from since to until (datetime or None), end is None - up
+           to the end of file; or None if there is no such lines.
+           Compressed file (and file with unknown times) is read fully.
+        '''
+        if since is None and until is None:
+            return (0, None)
+        times = self.getFileTimes(path)
+        if times is None:
+            return (0, None)
+        first, last = times
+        if since is not None and last < since:
+            return None
+        if until is not None and first > until:
+            return None
+        if self.isCompressed(path):
+            return (0, None)
+        start = 0
+        end = None
+        try:
+            if since is not None and first < since:
+                start = self.findTime(path, since)
+            if until is not None and last > until:
+                end = self.findTime(path, until, after=True)
+        except Exception as e:
+            print(str(e))
+            return (0, None)
+        if end is not None and end <= start:
+            return None
+        return (start, end)
+
     def getPostfixMLIndexAndRegex(self, fr):
         '''This method parse postfix log file an return index by
-           Postfix_mail_id as dictionary {MID: [seek_pos,]}
-           and dictionary {regex: [MID]}
+           Postfix_mail_id as OffsetIndex {MID: [seek_pos,]}
+           and dictionary {regex: set(MID)}
+           argument is tuple (f, r, start, end, size, window):
+           f - full path to log file, r - list of regex,
+           start, end - byte range of the file to parse (see getRanges),
+           size - lines before this position are in persistent index already,
+           window - None or (since, until) - regex are checked only for lines
+           from this time range (used if times of the file are unknown)
+           return tuple ((f, OffsetIndex), {regex: set(MID)},
+                         (idx_end, tail), gathered, times):
+           idx_end, tail - position after the last finished line and this
+           line, to save persistent index; gathered - see gatherLine;
+           times - see getFileTimes, only for compressed file
         '''
-        f = self.getFileHandler(fr[0])
+        path, regs, start, end, size, window = fr
+        if self.useMmap(path):
+            return self.getPostfixMLIndexAndRegexMmap(fr)
+        f = self.getFileHandler(path)
         if f is None:
-            return ((fr[0], {}), {})
-        postfixline = re.compile(self.postfixloglinereg)
-        reg_id_d = {}
+            return ((path, OffsetIndex()), {}, (0, b''), {}, None)
+        postfixline = self.getPostfixLineReg()
         id_seek_d = {}
-        rlist = {}
-        for i in fr[1]:
-            rstr = '(.*%s.*)' % i
-            rlist[i] = re.compile(rstr)
-        fpos = 0
+        reg_id_d = {}
+        mr = MultiRegex(regs, binary=True)
+        # persistent index contains only finished lines,
+        # in-memory index - the last (unfinished) line of file too
+        persist = self.index_dir is not None
+        build = persist or not self.noindex
+        # lines of the compressed file are gathered at the first phase:
+        # buffer of not finished messages and lines of matched messages
+        compressed = self.isCompressed(path)
+        gather = self.gather and build and compressed
+        buf_d = OrderedDict()
+        evicted = set()
+        gathered = {}
+        if start > 0:
+            f.seek(start)
+        fpos = start
+        idx_end = 0
+        tail = b''
+        first = None
+        mtime = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+        prefix = None
+        inwindow = True
+        nlines = 0
+        nfound = 0
         for line in f:
-            line = line.decode('utf-8')
+            if end is not None and fpos >= end:
+                break
+            nlines += 1
             plr = postfixline.match(line)
             if plr:
                 PMsgID = plr.group(1)
-                if not self.noindex:
+                if build and fpos >= size:
                     if PMsgID not in id_seek_d.keys():
-                        id_seek_d[PMsgID] = []
+                        id_seek_d[PMsgID] = array('Q')
                     id_seek_d[PMsgID].append(fpos)
-                for reg in fr[1]:
-                    if rlist[reg].match(line):
+                # syslog or RFC 3339 time up to seconds
+                plen = 19 if line[:1].isdigit() else 15
+                if window is not None and line[:plen] != prefix:
+                    # time is changed not often than once per second
+                    prefix = line[:plen]
+                    t = self.getLineTime(line[:64].decode('utf-8', 'replace'),
+                                         mtime)
+                    inwindow = t is None or \
+                        ((window[0] is None or t >= window[0]) and
+                         (window[1] is None or t <= window[1]))
+                if inwindow:
+                    found = mr.match(line)
+                else:
+                    found = []
+                if found:
+                    nfound += 1
+                    mid = PMsgID.decode('ascii')
+                    for reg in found:
                         if reg not in reg_id_d.keys():
-                            reg_id_d[reg] = []
-                        reg_id_d[reg].append(PMsgID)
+                            reg_id_d[reg] = set()
+                        reg_id_d[reg].add(mid)
+                if gather:
+                    self.gatherLine(PMsgID, line, found,
+                                    buf_d, evicted, gathered)
             fpos = f.tell()
+            if line[-1:] == b'\n':
+                idx_end = fpos
+                tail = line
+                if first is None:
+                    first = line
         f.close()
-        return ((fr[0], id_seek_d), reg_id_d)
+        ScanStats.add(bytes=fpos - start, lines=nlines, matches=nfound)
+        times = None
+        if compressed and first is not None:
+            times = (self.getLineTime(first.decode('utf-8', 'replace'),
+                                      mtime),
+                     self.getLineTime(tail.decode('utf-8', 'replace'),
+                                      mtime))
+        gathered = dict((mid.decode('ascii'),
+                         [self.decodeLine(i) for i in lines])
+                        for mid, lines in gathered.items())
+        return ((path, OffsetIndex.fromDict(id_seek_d)), reg_id_d,
+                (idx_end, tail[-64:]), gathered, times)
+
+    def openMmap(self, path):
+        '''Return tuple (file, mmap) of uncompressed file or None'''
+        try:
+            f = open(path, mode='rb')
+        except Exception as e:
+            print(str(e))
+            return None
+        try:
+            return (f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except (ValueError, OSError) as e:
+            print(str(e))
+            f.close()
+            return None
+
+    def getPostfixMLIndexAndRegexMmap(self, fr):
+        '''The same as getPostfixMLIndexAndRegex for uncompressed file:
+           the file is mapped to memory, offsets of lines are positions
+           of matches of postfix line regex (finditer over the buffer),
+           without reading line by line. If index is not needed (noindex
+           without index_dir) - only lines around matches of regex are
+           checked.
+        '''
+        path, regs, start, end, size, window = fr
+        fm = self.openMmap(path)
+        if fm is None:
+            return ((path, OffsetIndex()), {}, (0, b''), {}, None)
+        f, buf = fm
+        postfixline = self.getPostfixBufReg()
+        id_seek_d = {}
+        reg_id_d = {}
+        mr = MultiRegex(regs, binary=True)
+        persist = self.index_dir is not None
+        build = persist or not self.noindex
+        limit = len(buf)
+        if end is not None and end < limit:
+            # the line started before end is parsed up to its end
+            limit = buf.find(b'\n', max(end - 1, start), limit) + 1 or limit
+        mtime = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+        state = {'prefix': None, 'inwindow': True, 'found': 0}
+
+        def check(line, mid):
+            if window is not None:
+                # syslog or RFC 3339 time up to seconds
+                plen = 19 if line[:1].isdigit() else 15
+                if line[:plen] != state['prefix']:
+                    state['prefix'] = line[:plen]
+                    t = self.getLineTime(line[:64].decode('utf-8',
+                                                          'replace'), mtime)
+                    state['inwindow'] = t is None or \
+                        ((window[0] is None or t >= window[0]) and
+                         (window[1] is None or t <= window[1]))
+                if not state['inwindow']:
+                    return
+            found = mr.match(line)
+            if found:
+                state['found'] += 1
+                mid = mid.decode('ascii')
+                for reg in found:
+                    if reg not in reg_id_d.keys():
+                        reg_id_d[reg] = set()
+                    reg_id_d[reg].add(mid)
+
+        if build or mr.finder is None:
+            for m in postfixline.finditer(buf, start, limit):
+                fpos = m.start()
+                line = m.group(0)
+                if build and fpos >= size:
+                    mid = m.group(1)
+                    if mid not in id_seek_d.keys():
+                        id_seek_d[mid] = array('Q')
+                    id_seek_d[mid].append(fpos)
+                check(line, m.group(1))
+        elif mr.checks:
+            pos = start
+            while pos < limit:
+                m = mr.finder.search(buf, pos, limit)
+                if m is None:
+                    break
+                ls = buf.rfind(b'\n', pos, m.start()) + 1 or pos
+                le = buf.find(b'\n', m.start(), limit)
+                pos = limit if le < 0 else le + 1
+                plr = postfixline.match(buf, ls, pos)
+                if plr:
+                    check(plr.group(0), plr.group(1))
+        idx_end = buf.rfind(b'\n', start, limit) + 1
+        tail = b''
+        if idx_end > start:
+            ls = max(start, buf.rfind(b'\n', start, idx_end - 1) + 1)
+            tail = buf[max(ls, idx_end - 64):idx_end]
+        else:
+            idx_end = 0
+        nlines = 0
+        if self.stats:
+            # mmap has no count, it is counted by slices
+            for pos in range(start, limit, 16 * 1024 * 1024):
+                nlines += buf[pos:min(limit,
+                                      pos + 16 * 1024 * 1024)].count(b'\n')
+        ScanStats.add(bytes=limit - start, lines=nlines,
+                      matches=state['found'])
+        buf.close()
+        f.close()
+        return ((path, OffsetIndex.fromDict(id_seek_d)), reg_id_d,
+                (idx_end, tail), {}, None)
+
+    def gatherLine(self, mid, line, found, buf_d, evicted, gathered):
+        '''Gather lines of messages matched by regex at the first phase
+           of parsing the compressed file, so it is not decompressed
+           again at the second one:
+           mid and line are raw (bytes), lines are decoded by the caller;
+           buf_d - OrderedDict {MID: [lines]} of not finished messages,
+           limited by gather_limit, messages removed from it because of
+           limit are added to set evicted - their lines are read
+           at the second phase;
+           gathered - dict {MID: [lines]} of matched messages.
+        '''
+        if mid in gathered.keys():
+            gathered[mid].append(line)
+            return
+        if mid in evicted:
+            return
+        if mid not in buf_d.keys():
+            buf_d[mid] = []
+            if len(buf_d) > self.gather_limit:
+                evicted.add(buf_d.popitem(last=False)[0])
+        buf_d[mid].append(line)
+        if found:
+            gathered[mid] = buf_d.pop(mid)
+        elif line[-9:] == b': removed' or line[-10:] == b': removed\n':
+            del buf_d[mid]
 
     def getPostfixMLLines(self, fs):
         '''
@@ -160,73 +1752,242 @@ class Postfix:
         f = self.getFileHandler(fs[0])
         if f is None:
             return {}
+        postfixline = self.getPostfixLineReg()
         reg_d = {}
         for fpos in sorted(fs[1].keys()):
             f.seek(fpos)
-            line = f.readline().decode('utf-8')
+            bline = f.readline()
+            ScanStats.add(bytes=len(bline), lines=1)
+            # offsets of messages with the same hash are shared
+            plr = postfixline.match(bline)
+            if not plr:
+                continue
+            pmid = plr.group(1).decode('ascii')
+            line = None
             for reg in fs[1][fpos]:
                 if reg not in reg_d.keys():
                     reg_d[reg] = {}
                 for mid in fs[1][fpos][reg]:
+                    if mid != pmid:
+                        continue
+                    if line is None:
+                        line = self.decodeLine(bline)
                     if mid not in reg_d[reg].keys():
                         reg_d[reg][mid] = []
                     reg_d[reg][mid].append(line)
         f.close()
         return reg_d
 
-    def getPostfixMailLogs(self, r):
+    def invertRegIDs(self, reg_d):
+        '''Return inverted map {MID: [regex,]} of {regex: set(MID)}'''
+        id_reg_d = {}
+        for reg in reg_d.keys():
+            for mid in reg_d[reg]:
+                if mid not in id_reg_d.keys():
+                    id_reg_d[mid] = []
+                id_reg_d[mid].append(reg)
+        return id_reg_d
+
+    def joinIndex(self, id_reg_d, idx_l, gather_d={}):
+        '''Join found message IDs {MID: [regex,]} with indexes of files
+           [(f, OffsetIndex),], return list of tasks for getPostfixMLLines
+           [(f, {seek_pos: {regex: [MID]}}),]. Every ID is looked up once
+           per file, so time is linear in number of found IDs.
+           Messages gathered at the first phase {f: {MID: [lines]}}
+           are skipped.
+        '''
+        fs = []
+        hashes = [(idHash(mid), mid, regs) for mid, regs in id_reg_d.items()]
+        for file_path, index in idx_l:
+            gathered = gather_d.get(file_path, {})
+            seek_d = {}
+            for h, mid, regs in hashes:
+                if mid in gathered.keys():
+                    continue
+                for sid in index.getHash(h):
+                    if sid not in seek_d.keys():
+                        seek_d[sid] = {}
+                    for reg in regs:
+                        if reg not in seek_d[sid].keys():
+                            seek_d[sid][reg] = []
+                        seek_d[sid][reg].append(mid)
+            if seek_d != {}:
+                fs.append((file_path, seek_d))
+        return fs
+
+    def getPostfixMailLogs(self, r, since=None, until=None):
         '''Return dict (keys is regex) of dict with keys - Postfix message ID
            and list of strings from log file with this message - from All log
-           files
+           files.
+           since, until - datetime, parse only log lines from this time
+           range: files out of the range are skipped, uncompressed files
+           are read from the position found by binary search
+           Time of every phase is added to timings.
+           Results of unchanged files are taken from ResultCache
+           (if index_dir and cache_size are set).
         '''
+        t = self.startTiming()
         fr = []
         gf = self.getFiles()
+        self.cleanIndex(gf)
+        # live file is found once for all workers
+        self.live_file = None
+        if self.engine != 'lines':
+            self.live_file = self.getLiveFile() or ''
+        cache = None
+        if self.index_dir is not None and self.cache_size and \
+                not self.noindex:
+            cache = ResultCache(self, r, (self.decode_errors,))
+        cached = {}
+        idx_d = {}
+        nosave = set()
+        # files cut by since/until, their results are not cached
+        nocache = set()
         for f in gf:
-            fr.append((f, r))
-        if self.multiprocess:
-            res_l = Pool().map(self.getPostfixMLIndexAndRegex, fr)
-        else:
-            res_l = list(map(self.getPostfixMLIndexAndRegex, fr))
+            window = self.getWindow(f, since, until)
+            if window is None:
+                continue
+            # time of lines is checked if the file can not be cut by window
+            check = None
+            if window == (0, None) and \
+                    not self.inWindow(self.getFileTimes(f), since, until):
+                check = (since, until)
+            idx_d[f] = self.loadIndex(f)
+            if window != (0, None) or check is not None:
+                nocache.add(f)
+            elif cache is not None:
+                entry = cache.load(f, idx_d[f])
+                if entry is not None:
+                    cached[f] = entry
+                    continue
+            # persistent index must not have a gap
+            if window[0] > idx_d[f][1]:
+                nosave.add(f)
+            if self.multiprocess:
+                ranges = self.getRanges(f)
+            else:
+                ranges = [(0, None)]
+            for start, end in ranges:
+                start = max(start, window[0])
+                if window[1] is not None:
+                    if end is None or end > window[1]:
+                        end = window[1]
+                if end is None or start < end:
+                    fr.append((f, r, start, end, idx_d[f][1], check))
+        t = self.addTiming('files', t)
         reg_d = {}
-        for i in res_l:
+        end_d = {}
+        gather_d = {}
+        # IDs found in every file, for cache
+        file_ids = {}
+        for fri, i in self.imap(self.getPostfixMLIndexAndRegex, fr):
+            file_path = i[0][0]
+            if file_path not in file_ids.keys():
+                file_ids[file_path] = {}
             for reg in i[1].keys():
                 if reg not in reg_d.keys():
-                    reg_d[reg] = []
-                reg_d[reg].extend(i[1][reg])
-                reg_d[reg] = list(set(reg_d[reg]))
+                    reg_d[reg] = set()
+                reg_d[reg].update(i[1][reg])
+                if reg not in file_ids[file_path].keys():
+                    file_ids[file_path][reg] = set()
+                file_ids[file_path][reg].update(i[1][reg])
+            key, size, index = idx_d[file_path]
+            idx_d[file_path] = (key, size, index.merge(i[0][1]))
+            if i[2][0] > end_d.get(file_path, (0, b''))[0]:
+                end_d[file_path] = i[2]
+            if i[3]:
+                gather_d[file_path] = i[3]
+            self.setFileTimes(file_path, i[4])
+        self.saveTimes(gf)
+        for f, entry in cached.items():
+            for reg in entry['ids'].keys():
+                if reg not in reg_d.keys():
+                    reg_d[reg] = set()
+                reg_d[reg].update(entry['ids'][reg])
+        idx_l = []
+        for f in gf:
+            if f not in idx_d.keys():
+                continue
+            key, size, index = idx_d[f]
+            if f in end_d.keys() and end_d[f][0] > size and \
+                    f not in nosave:
+                self.saveIndex(key, end_d[f][0], end_d[f][1],
+                               index.cut(end_d[f][0]))
+            idx_l.append((f, index))
+        t = self.addTiming('index', t)
         if self.noindex:
             reg_dr = {}
             for reg in reg_d.keys():
-                reg_dr[reg] = self.getPostfixMailLogsByID(reg_d[reg])
+                reg_dr[reg] = self.getPostfixMailLogsByID(sorted(reg_d[reg]))
             return reg_dr
-        fs = []
-        for i in res_l:
-            file_path = i[0][0]
-            seek_d = {}
-            for mid in i[0][1].keys():
-                for reg in reg_d.keys():
-                    if mid in reg_d[reg]:
-                        for sid in i[0][1][mid]:
-                            if sid not in seek_d.keys():
-                                seek_d[sid] = {}
-                            if reg not in seek_d[sid].keys():
-                                seek_d[sid][reg] = []
-                            seek_d[sid][reg].append(mid)
-            if seek_d != {}:
-                fs.append((file_path, seek_d))
-        if self.multiprocess:
-            res_l = Pool().map(self.getPostfixMLLines, fs)
-        else:
-            res_l = map(self.getPostfixMLLines, fs)
+        id_reg_d = self.invertRegIDs(reg_d)
+        # lines of messages looked up already are taken from cache,
+        # the others are read from file by index
+        for f, entry in cached.items():
+            gather_d[f] = dict((mid, entry['lines'][mid])
+                               for mid in id_reg_d.keys()
+                               if mid in entry['lines'].keys())
+            for mid in entry['looked']:
+                if mid in id_reg_d.keys() and mid not in gather_d[f].keys():
+                    gather_d[f][mid] = []
+        fs = self.joinIndex(id_reg_d, idx_l, gather_d)
+        t = self.addTiming('join', t)
         reg_d = {}
-        for i in res_l:
+        file_lines = {}
+
+        def add(i, f):
+            if cache is not None:
+                if f not in file_lines.keys():
+                    file_lines[f] = {}
+                for reg in i.keys():
+                    for mid in i[reg].keys():
+                        file_lines[f][mid] = i[reg][mid]
             for reg in i.keys():
                 if reg not in reg_d.keys():
                     reg_d[reg] = {}
                 for mid in i[reg].keys():
+                    if not i[reg][mid]:
+                        continue
                     if mid not in reg_d[reg].keys():
                         reg_d[reg][mid] = []
                     reg_d[reg][mid].extend(i[reg][mid])
+
+        # results are merged in order of files as they come, lines
+        # gathered at the first phase are before lines of the file
+        # read at the second one
+        res_it = self.imap(self.getPostfixMLLines, fs, ordered=True)
+        fs_files = set(j[0] for j in fs)
+        for f in gf:
+            if f in gather_d.keys():
+                reg_g = {}
+                for mid, lines in gather_d.pop(f).items():
+                    for reg in id_reg_d.get(mid, []):
+                        if reg not in reg_g.keys():
+                            reg_g[reg] = {}
+                        reg_g[reg][mid] = lines
+                add(reg_g, f)
+            if f in fs_files:
+                add(next(res_it)[1], f)
+        if cache is not None:
+            for f in idx_d.keys():
+                if idx_d[f][0] is None or f in nocache:
+                    continue
+                if f in cached.keys():
+                    entry = cached[f]
+                    if set(id_reg_d.keys()) <= entry['looked']:
+                        continue
+                else:
+                    entry = {'key': idx_d[f][0],
+                             'ids': file_ids.get(f, {}),
+                             'looked': set(),
+                             'lines': {}}
+                entry['looked'].update(id_reg_d.keys())
+                for mid, lines in file_lines.get(f, {}).items():
+                    if lines:
+                        entry['lines'][mid] = lines
+                cache.save(entry)
+            cache.evict(gf)
+        self.addTiming('lines', t)
         return reg_d
 
     def dropMessage(self, pmid):
@@ -243,107 +2004,1425 @@ class Postfix:
             s = str(e)
         return (p.stdout.read(), p.stderr.read(), s)
 
+    def dropMessages(self, pmids):
+        '''Drop list of messages from postfix queue with one postsuper
+           process (queue IDs are read from stdin), return dict
+           {MsgID: (stdin, stderr, exception(as string))} - the same as
+           dropMessage, stderr contains lines about this message or
+           all the output of postsuper if there is no such lines'''
+        s = ''
+        out = ''
+        err = ''
+        timeout = 10 + len(pmids) // 100
+        p = subprocess.Popen([self.postsuper, '-d', '-'],
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             universal_newlines=True)
+        try:
+            out, err = p.communicate('%s\n' % '\n'.join(pmids),
+                                     timeout=timeout)
+        except Exception as e:
+            s = str(e)
+            p.kill()
+            out, err = p.communicate()
+        ids = set(pmids)
+        id_err = {}
+        for line in err.splitlines(True):
+            parts = line.split(': ')
+            if len(parts) > 2 and parts[1] in ids:
+                if parts[1] not in id_err.keys():
+                    id_err[parts[1]] = ''
+                id_err[parts[1]] += line
+        res = {}
+        for pmid in pmids:
+            res[pmid] = (out, id_err.get(pmid, err), s)
+        return res
+
     def isFilter(self, rec, mindate, maxdate, from_regex, to_regex):
-        if 'time' in rec.keys():
-            if mindate is not None and rec['time'] < mindate:
-                return False
-            if maxdate is not None and rec['time'] > maxdate:
-                return False
-        else:
-            if mindate is not None or maxdate is not None:
-                return False
-        if 'from' in rec.keys():
-            if from_regex is not None:
-                frc = re.compile(from_regex)
-                if not frc.match(rec['from']):
-                    return False
+        '''Check record of mail queue by old style filters,
+           see QueueFilter'''
+        key = (mindate, maxdate, from_regex, to_regex)
+        if key not in self.filters.keys():
+            self.filters[key] = QueueFilter(mindate=mindate,
+                                            maxdate=maxdate,
+                                            from_regex=from_regex,
+                                            to_regex=to_regex)
+        return self.filters[key](rec)
+
+    def readQueueJSON(self):
+        '''Read mail queue with `postqueue -j` (Postfix >= 3.1), return
+           generator of tuples (MsgID, record) - records are parsed
+           one by one while postqueue writes them, or None if
+           postqueue -j is not supported (then mailq output is parsed).
+           Record is the same as for mailq, plus queue name.
+        '''
+        try:
+            mp = subprocess.Popen([self.postqueue, '-j'],
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  universal_newlines=True)
+        except Exception:
+            return None
+        first = mp.stdout.readline()
+        if first == '':
+            if mp.wait() != 0:
+                return None
         else:
-            if from_regex is not None:
-                return False
-        if 'to' in rec.keys():
-            if to_regex is not None:
-                trc = re.compile(to_regex)
-                for i in rec['to']:
-                    if trc.match(i):
-                        return True
+            try:
+                first = json.loads(first)
+            except ValueError:
+                mp.kill()
+                mp.wait()
+                return None
+        return self.iterQueueJSON(mp, first)
+
+    def iterQueueJSON(self, mp, first):
+        '''Generator for readQueueJSON, postqueue is stopped if the
+           generator is closed before the end'''
+        if first == '':
+            return
+        js = first
+        try:
+            while True:
+                rec = {'size': js['message_size'],
+                       'time': datetime.datetime.fromtimestamp(
+                           js['arrival_time']),
+                       'from': js['sender'] or 'MAILER-DAEMON',
+                       'queue': js['queue_name']}
+                for rcpt in js['recipients']:
+                    if 'to' not in rec.keys():
+                        rec['to'] = []
+                    rec['to'].append(rcpt['address'])
+                    if 'message' not in rec.keys() and \
+                            'delay_reason' in rcpt:
+                        rec['message'] = rcpt['delay_reason']
+                yield (js['queue_id'], rec)
+                line = mp.stdout.readline()
+                if line == '':
+                    break
+                js = json.loads(line)
+        finally:
+            if mp.poll() is None:
+                mp.kill()
+            mp.wait()
+
+    def readRecord(self, f):
+        '''Read one record of queue file: type (1 byte), length (7 bits
+           per byte, low bits first, high bit - more bytes) and data,
+           return tuple (type, data) or None at the end of file'''
+        rtype = f.read(1)
+        if rtype == b'':
+            return None
+        length = 0
+        shift = 0
+        while True:
+            b = f.read(1)
+            if b == b'' or shift > 28:
+                raise ValueError('Bad record length at %d' % f.tell())
+            length |= (b[0] & 0x7f) << shift
+            if not b[0] & 0x80:
+                break
+            shift += 7
+        data = f.read(length)
+        if len(data) != length:
+            raise ValueError('Short record at %d' % f.tell())
+        return (rtype, data)
+
+    def readQueueFile(self, path):
+        '''Parse queue file, return record as for mailq (size, time,
+           from, to - recipients not delivered yet). Message content is
+           skipped by offset from size record (C), pointer records (p)
+           are followed.'''
+        rec = {'to': []}
+        size = None
+        offset = None
+        jumps = 0
+        with open(path, mode='rb') as f:
+            while True:
+                r = self.readRecord(f)
+                if r is None:
+                    break
+                rtype, data = r
+                if rtype == b'E':
+                    break
+                elif rtype == b'C':
+                    fields = data.split()
+                    size = int(fields[0])
+                    offset = int(fields[1])
+                    rec['size'] = size
+                elif rtype == b'T':
+                    rec['time'] = datetime.datetime.fromtimestamp(
+                        int(data.split()[0]))
+                elif rtype == b'S':
+                    rec['from'] = data.decode('utf-8', 'replace') or \
+                        'MAILER-DAEMON'
+                elif rtype == b'R':
+                    rec['to'].append(data.decode('utf-8', 'replace'))
+                elif rtype == b'p':
+                    ptr = int(data)
+                    if ptr > 0:
+                        jumps += 1
+                        if jumps > 10000:
+                            raise ValueError('Pointer loop')
+                        f.seek(ptr)
+                elif rtype == b'M' and size is not None and offset:
+                    f.seek(offset + size)
+            if 'size' not in rec.keys():
+                # postdrop file in maildrop has no size record
+                rec['size'] = os.fstat(f.fileno()).st_size
+        if 'time' not in rec.keys():
+            raise ValueError('There is no arrival time')
+        if not rec['to']:
+            del rec['to']
+        return rec
+
+    def readDeferLog(self, path):
+        '''Return list of reasons from defer log (blocks of name=value
+           lines, one block per recipient)'''
+        reasons = []
+        with open(path, mode='rb') as f:
+            for line in f:
+                if line[:7] == b'reason=':
+                    reasons.append(line[7:].decode('utf-8',
+                                                   'replace').rstrip('\n'))
+        return reasons
+
+    def walkQueue(self, name):
+        '''Generator of tuples (MsgID, path, stat) of files of queue
+           directory (with hashed subdirectories) in order of names'''
+        for root, dirnames, filenames in os.walk(os.path.join(self.queue_dir,
+                                                              name)):
+            dirnames.sort()
+            for fname in sorted(filenames):
+                path = os.path.join(root, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield (fname, path, st)
+
+    def getQueueHash(self, pmid):
+        '''Return name of hashed subdirectories of queue ID as postfix
+           makes it: hex digits of microseconds - the beginning of short
+           ID or decoded 4 digits before separator z of long ID'''
+        sep = pmid.rfind('z')
+        if sep < 10:
+            return pmid
+        usec = 0
+        try:
+            for c in pmid[sep - 4:sep]:
+                usec = usec * 52 + self.LONG_ID_DIGITS.index(c)
+        except ValueError:
+            return pmid
+        return '%05X' % usec
+
+    def getDeferPath(self, pmid, path, qdir):
+        '''Return path of defer log of the queue file path in queue
+           directory qdir. Defer log has the same hashed subdirectory
+           for hashed queue, for not hashed queue (hash_queue_names has
+           only deferred, defer by default) it is found by hash of queue
+           ID, depth is taken from existing subdirectories of defer.'''
+        rel = os.path.relpath(os.path.dirname(path), qdir)
+        if rel != '.':
+            return os.path.join(self.queue_dir, 'defer', rel, pmid)
+        dpath = os.path.join(self.queue_dir, 'defer')
+        for c in self.getQueueHash(pmid):
+            if not os.path.isdir(os.path.join(dpath, c)):
+                break
+            dpath = os.path.join(dpath, c)
+        return os.path.join(dpath, pmid)
+
+    def loadQueueCache(self):
+        '''Cache of parsed queue files {path: (key, record)},
+           it is kept in index_dir between runs'''
+        if self.queue_cache is None:
+            self.queue_cache = {}
+            if self.index_dir is not None:
+                try:
+                    with open(os.path.join(self.index_dir,
+                                           'queue.pickle'), 'rb') as f:
+                        self.queue_cache = pickle.load(f)
+                except Exception:
+                    self.queue_cache = {}
+        return self.queue_cache
+
+    def saveQueueCache(self):
+        if self.index_dir is None or self.queue_cache is None:
+            return
+        fname = os.path.join(self.index_dir, 'queue.pickle')
+        tmp = '%s.%d.tmp' % (fname, os.getpid())
+        try:
+            os.makedirs(self.index_dir, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                pickle.dump(self.queue_cache, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, fname)
+        except Exception as e:
+            print(str(e))
+
+    def iterQueueDir(self, unparsed=None):
+        '''Read mail queue from queue_dir (incoming, active, deferred,
+           hold, maildrop) without mailq, generator of tuples (MsgID, record),
+           record is the same as for postqueue -j (message - the first
+           reason from defer log). If index_dir is set, parsed files are
+           cached by inode, mtime and size (and mtime of defer log), so
+           only new or changed files are parsed on next run. Errors are
+           added to list unparsed.
+        '''
+        cache = self.loadQueueCache()
+        # cache is kept only if it is saved, otherwise memory does not
+        # depend on size of queue
+        new_cache = {} if self.index_dir is not None else None
+        for queue_name in self.QUEUES:
+            qdir = os.path.join(self.queue_dir, queue_name)
+            for pmid, path, st in self.walkQueue(queue_name):
+                # incoming (maildrop) file is finished by cleanup
+                # (postdrop) when owner execute bit is set
+                if queue_name in ('incoming', 'maildrop') and \
+                        not st.st_mode & 0o100:
+                    continue
+                key = (st.st_ino, st.st_mtime_ns, st.st_size)
+                dpath = self.getDeferPath(pmid, path, qdir)
+                try:
+                    key += (os.stat(dpath).st_mtime_ns,)
+                except OSError:
+                    dpath = None
+                if path in cache.keys() and cache[path][0] == key:
+                    rec = cache[path][1]
                 else:
-                    return False
-        else:
-            if to_regex is not None:
-                return False
-        return True
+                    try:
+                        rec = self.readQueueFile(path)
+                        if dpath is not None:
+                            reasons = self.readDeferLog(dpath)
+                            if reasons:
+                                rec['message'] = reasons[0]
+                    except Exception as e:
+                        if unparsed is not None:
+                            unparsed.append('%s: %s' % (path, str(e)))
+                        continue
+                rec['queue'] = queue_name
+                if new_cache is not None:
+                    new_cache[path] = (key, rec)
+                yield (pmid, dict(rec))
+        if new_cache is not None:
+            self.queue_cache = new_cache
+            self.saveQueueCache()
+
+    def parseMailq(self, lines, unparsed):
+        '''Generator of tuples (MsgID, record) of mailq output lines,
+           record is finished by empty line or by the end of output,
+           lines which can not be parsed are added to list unparsed'''
+        rs = r'(\w+)([*!]?)\s+(\d+)\s+(\w{3}\s+\w{3}\s+\d+\s+\d+:\d+:\d+)\s+(%s)' % self.mail_reg
+        fl_re = re.compile(rs)
+        msg_re = re.compile(r'\s*\((.*)\)\s*')
+        toaddr_re = re.compile(r'\s*(%s)\s*' % self.mail_reg)
+        n = datetime.datetime.now()
+        pmid = ''
+        rec = {}
+        for line in lines:
+            if line[0] == '-':
+                continue
+            elif line == '\n':
+                if pmid != '':
+                    yield (pmid, rec)
+                rec = {}
+                pmid = ''
+                continue
+            fl_result = fl_re.match(line)
+            msg_result = msg_re.match(line)
+            toaddr_result = toaddr_re.match(line)
+            if fl_result:
+                # mailq time has no year: it is this year or the last one
+                # (if it is in future or Feb 29 of not leap year)
+                try:
+                    t = datetime.datetime.strptime(
+                        '%d %s' % (n.year, fl_result.group(4)),
+                        '%Y %a %b %d %H:%M:%S')
+                except ValueError:
+                    t = None
+                try:
+                    if t is None or t > n:
+                        t = datetime.datetime.strptime(
+                            '%d %s' % (n.year - 1, fl_result.group(4)),
+                            '%Y %a %b %d %H:%M:%S')
+                except ValueError:
+                    unparsed.append(line)
+                    continue
+                pmid = fl_result.group(1)
+                rec['queue'] = QueueFilter.FLAGS.get(fl_result.group(2),
+                                                     'deferred')
+                rec['size'] = int(fl_result.group(3))
+                rec['time'] = t
+                rec['from'] = fl_result.group(5)
+            elif msg_result:
+                rec['message'] = msg_result.group(1)
+            elif toaddr_result:
+                if 'to' not in rec.keys():
+                    rec['to'] = []
+                rec['to'].append(toaddr_result.group(1))
+            else:
+                unparsed.append(line)
+        if pmid != '':
+            yield (pmid, rec)
+
+    def readMailq(self, unparsed):
+        '''Generator of tuples (MsgID, record) of mailq output, see
+           parseMailq, errors of mailq are added to list unparsed'''
+        mp = subprocess.Popen([self.mailq],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        try:
+            for pmid, rec in self.parseMailq(mp.stdout, unparsed):
+                yield (pmid, rec)
+            unparsed.extend(mp.stderr.readlines())
+        finally:
+            if mp.poll() is None:
+                mp.kill()
+            mp.stdout.close()
+            mp.stderr.close()
+            mp.wait()
+
+    def iterQueue(self, flt=None, unparsed=None):
+        '''Generator of tuples (MsgID, record) of mail queue (read by
+           queue_backend) filtered by flt (QueueFilter or function of
+           record, None - all records). Records are parsed one by one as
+           mailq (postqueue -j, queue files) gives them, so memory does
+           not depend on size of queue. Errors and lines which can not be
+           parsed are added to list unparsed.
+        '''
+        if unparsed is None:
+            unparsed = []
+        records = None
+        if self.queue_backend == 'dir':
+            records = self.iterQueueDir(unparsed)
+        elif self.queue_backend != 'text':
+            records = self.readQueueJSON()
+            if records is None and self.queue_backend == 'json':
+                unparsed.append('%s -j is not supported' % self.postqueue)
+                return
+        if records is None:
+            records = self.readMailq(unparsed)
+        for pmid, rec in records:
+            if flt is None or flt(rec):
+                yield (pmid, rec)
 
     def queueMng(self,
                  mindate=None,
                  maxdate=None,
                  from_regex=None,
                  to_regex=None,
-                 delete=False):
+                 delete=False,
+                 callback=None,
+                 filter_expr=None):
         '''Manage th Postfix mail queue - return dictionary
-           with filtered or deleted messages'''
+           with filtered or deleted messages (see iterQueue).
+           filter_expr - filter expression, see QueueFilter.
+           If callback is defined - it is called as callback(MsgID, record)
+           for every filtered record instead of adding it to dictionary,
+           so only key 'unparsed' is returned'''
         mq = {}
         unparsed = []
-        mp = subprocess.Popen([self.mailq],
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              universal_newlines=True)
-        rs = r'(\w+)[*!]?\s+(\d+)\s+(\w{3}\s+\w{3}\s+\d+\s+\d+:\d+:\d+)\s+(%s)' % self.mail_reg
-        fl_re = re.compile(rs)
-        msg_re = re.compile(r'\s*\((.*)\)\s*')
-        toaddr_re = re.compile(r'\s*(%s)\s*' % self.mail_reg)
-        pmid = ''
-        rec = {}
-        while mp.poll() is None:
-            for line in mp.stdout:
-                if line[0] == '-':
+        drop = []
+        flt = QueueFilter(expr=filter_expr,
+                          mindate=mindate,
+                          maxdate=maxdate,
+                          from_regex=from_regex,
+                          to_regex=to_regex)
+
+        def add(pmid, rec):
+            rec['time'] = rec['time'].isoformat(' ')
+            if callback is None:
+                mq[pmid] = rec
+            else:
+                callback(pmid, rec)
+
+        def flush():
+            res = self.dropMessages([i[0] for i in drop])
+            for pmid, rec in drop:
+                rec['deleted'] = res[pmid]
+                add(pmid, rec)
+            del drop[:]
+
+        for pmid, rec in self.iterQueue(flt, unparsed):
+            if delete:
+                drop.append((pmid, rec))
+                if len(drop) >= self.delete_batch:
+                    flush()
+            else:
+                add(pmid, rec)
+        if drop:
+            flush()
+        mq['unparsed'] = unparsed
+        return mq
+
+    def queueHistogram(self, flt=None, limit=100):
+        '''Return QueueHistogram of mail queue records filtered by flt
+           (see iterQueue), limit - number of counters of domains and
+           reasons. Records are not kept, only counted.'''
+        hist = QueueHistogram(limit=limit)
+        unparsed = []
+        for pmid, rec in self.iterQueue(flt, unparsed):
+            hist.add(rec)
+            if unparsed:
+                hist.unparsed += len(unparsed)
+                del unparsed[:]
+        hist.unparsed += len(unparsed)
+        return hist
+
+
+class QueueHistogram:
+    '''Histograms of mail queue built in one pass with constant memory:
+       number of messages by age, by size class and by queue, number of
+       messages by destination domain and by deferral reason (hosts and
+       addresses are replaced by HOST). Domains and reasons are counted
+       by Space-Saving algorithm in not more than limit counters: if all
+       counters are used, new key replaces the key with the minimal
+       count and gets its count + 1, so frequent keys are always counted,
+       count of a key may be more than real by the minimal count.
+    '''
+
+    AGES = [(300, '5m'), (3600, '1h'), (4 * 3600, '4h'), (86400, '1d'),
+            (2 * 86400, '2d'), (5 * 86400, '5d')]
+    SIZES = [(10 * 1024, '10k'), (100 * 1024, '100k'), (1024 ** 2, '1m'),
+             (10 * 1024 ** 2, '10m')]
+    HOST = re.compile(r'\S+\[[0-9a-fA-F.:]+\](?::\d+)?|<[^>]*>')
+    FIELD = re.compile(r'[^a-zA-Z0-9_]')
+
+    def __init__(self, limit=100, now=None):
+        self.limit = limit
+        self.now = now or datetime.datetime.now()
+        self.total = 0
+        self.bytes = 0
+        self.unparsed = 0
+        self.age = OrderedDict((n, 0) for n in self.bucketNames(self.AGES))
+        self.size = OrderedDict((n, 0) for n in
+                                self.bucketNames(self.SIZES))
+        self.queue = dict((q, 0) for q in Postfix.QUEUES)
+        self.domains = {}
+        self.reasons = {}
+
+    def bucketNames(self, buckets):
+        return ['le_%s' % b[1] for b in buckets] + \
+            ['gt_%s' % buckets[-1][1]]
+
+    def bucket(self, buckets, value):
+        '''Return name of bucket of value'''
+        for limit, name in buckets:
+            if value <= limit:
+                return 'le_%s' % name
+        return 'gt_%s' % buckets[-1][1]
+
+    def count(self, counters, key):
+        if key in counters.keys():
+            counters[key] += 1
+        elif len(counters) < self.limit:
+            counters[key] = 1
+        else:
+            old = min(counters, key=counters.get)
+            counters[key] = counters.pop(old) + 1
+
+    def add(self, rec):
+        '''Count record of mail queue (see Postfix.iterQueue)'''
+        self.total += 1
+        size = rec.get('size', 0)
+        self.bytes += size
+        if 'time' in rec.keys():
+            age = (self.now - rec['time']).total_seconds()
+            self.age[self.bucket(self.AGES, age)] += 1
+        self.size[self.bucket(self.SIZES, size)] += 1
+        queue_name = rec.get('queue', 'deferred')
+        self.queue[queue_name] = self.queue.get(queue_name, 0) + 1
+        for domain in set(i.rpartition('@')[2].lower()
+                          for i in rec.get('to', [])):
+            self.count(self.domains, domain)
+        if rec.get('message'):
+            self.count(self.reasons,
+                       self.HOST.sub('HOST', rec['message'])[:100])
+
+    def top(self, counters, top):
+        res = sorted(counters.items(), key=lambda i: (-i[1], i[0]))
+        return OrderedDict(res[:top] if top else res)
+
+    def result(self, top=10):
+        '''Return histograms as dict, top - number of domains and
+           reasons (0 - all counted)'''
+        return {'total': self.total,
+                'bytes': self.bytes,
+                'unparsed': self.unparsed,
+                'age': self.age,
+                'size': self.size,
+                'queue': self.queue,
+                'domain': self.top(self.domains, top),
+                'reason': self.top(self.reasons, top)}
+
+    def nagios(self, top=10, warning=None, critical=None):
+        '''Return tuple (exit code, Nagios plugin output with perfdata),
+           warning, critical - thresholds of number of messages'''
+        state = 0
+        if critical is not None and self.total >= critical:
+            state = 2
+        elif warning is not None and self.total >= warning:
+            state = 1
+        perf = ["'total'=%d;%s;%s;0;" % (self.total,
+                                         '' if warning is None else warning,
+                                         '' if critical is None else critical),
+                "'bytes'=%dB;;;0;" % self.bytes]
+        res = self.result(top)
+        for group in ('queue', 'age', 'size', 'domain'):
+            for k, v in res[group].items():
+                # ' and = can not be in label
+                label = ('%s_%s' % (group, k)).replace("'", '').replace(
+                    '=', '_')
+                perf.append("'%s'=%d;;;0;" % (label, v))
+        text = '%d messages in queue (%d bytes)' % (self.total, self.bytes)
+        if res['reason']:
+            text += ', top reason: %s' % next(iter(res['reason'].keys()))
+        return (state, 'Mail queue %s: %s|%s' % (
+            ['OK', 'WARNING', 'CRITICAL'][state], text, ' '.join(perf)))
+
+    def munin(self, top=10, config=False):
+        '''Return munin multigraph output (values or config)'''
+        res = self.result(top)
+        lines = []
+        for group in ('queue', 'age', 'size', 'domain', 'reason'):
+            lines.append('multigraph postmgr_%s' % group)
+            if config:
+                lines.append('graph_title Mail queue by %s' % group)
+                lines.append('graph_vlabel messages')
+                lines.append('graph_category postfix')
+            for k, v in res[group].items():
+                field = self.FIELD.sub('_', k)[:40]
+                if field[:1].isdigit() or field == '':
+                    field = '_' + field
+                if config:
+                    lines.append('%s.label %s' % (field, k))
+                    lines.append('%s.min 0' % field)
+                else:
+                    lines.append('%s.value %d' % (field, v))
+        return '\n'.join(lines) + '\n'
+
+
+class ResultCache:
+    '''Cache of results of log parsing (getPostfixMailLogs) in
+       index_dir/cache, one entry per log file, set of regex and mode
+       (decode_errors). Only results of the whole file are cached (file
+       is inside since/until range), so the same entry is used for any
+       range, e.g. relative --since of every rerun. Entry keeps IDs found
+       in the file by every regex and lines of messages looked up in the
+       file, so the same query parses only changed files (usually the
+       live log), lines of new IDs are read from unchanged files by their
+       persistent index. Entry is used only if the file key (see
+       Postfix.getFileKey) is the same. Entries of deleted files are
+       removed, the least recently used ones - if size of cache is more
+       than cache_size.
+    '''
+
+    def __init__(self, postfix, patterns, mode):
+        self.postfix = postfix
+        self.path = os.path.join(postfix.index_dir, 'cache')
+        self.digest = hashlib.blake2b(repr((sorted(set(patterns)),
+                                            mode)).encode('utf-8'),
+                                      digest_size=8).hexdigest()
+
+    def getEntryPath(self, key):
+        return os.path.join(self.path, '%d-%d-%s.rc' % (key[0], key[1],
+                                                        self.digest))
+
+    def load(self, path, idx):
+        '''Return entry of the file {'key', 'ids': {regex: set(MID)},
+           'looked': set(MID), 'lines': {MID: [lines]}} or None,
+           idx - persistent index of the file (key, size, OffsetIndex),
+           it must contain the whole file to look up new IDs'''
+        key, size, index = idx
+        if key is None or \
+                (size != key[2] and not self.postfix.isCompressed(path)) or \
+                size == 0:
+            return None
+        epath = self.getEntryPath(key)
+        try:
+            with open(epath, 'rb') as f:
+                entry = pickle.loads(zlib.decompress(f.read()))
+            if entry['key'] != key:
+                return None
+            # modification time is time of the last use
+            os.utime(epath)
+        except Exception:
+            return None
+        return entry
+
+    def save(self, entry):
+        epath = self.getEntryPath(entry['key'])
+        tmp = '%s.%d.tmp' % (epath, os.getpid())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(zlib.compress(pickle.dumps(
+                    entry, protocol=pickle.HIGHEST_PROTOCOL), 1))
+            os.replace(tmp, epath)
+        except Exception as e:
+            print(str(e))
+
+    def evict(self, files):
+        '''Remove entries of files which are not exists now and the least
+           recently used entries over cache_size'''
+        if not os.path.isdir(self.path):
+            return
+        keep = set()
+        for path in files:
+            key = self.postfix.getFileKey(path)
+            if key is not None:
+                keep.add('%d-%d' % (key[0], key[1]))
+        entries = []
+        for name in os.listdir(self.path):
+            epath = os.path.join(self.path, name)
+            try:
+                if name[-3:] == '.rc' and \
+                        name.rsplit('-', 1)[0] in keep:
+                    st = os.stat(epath)
+                    entries.append((st.st_mtime, st.st_size, epath))
+                elif name[-3:] == '.rc':
+                    os.remove(epath)
+            except Exception as e:
+                print(str(e))
+        total = sum(e[1] for e in entries)
+        for mtime, size, epath in sorted(entries):
+            if total <= self.postfix.cache_size:
+                break
+            try:
+                os.remove(epath)
+                total -= size
+            except Exception as e:
+                print(str(e))
+
+
+class EventStore:
+    '''Typed events of postfix log lines in columnar store, one segment
+       per log file in index_dir (follows the file after rotation, only
+       new lines of live file are parsed - as persistent index).
+       Segment keeps columns as arrays: numbers as they are (missing
+       are NaN or -1), strings are dictionary encoded (array of codes
+       and list of distinct values), so group by and filters by strings
+       work on codes and values are compared only once per segment.
+       Segment is pickled and compressed by zlib.
+       Events (column event):
+       client - smtpd accepted connection (client),
+       message-id - cleanup (message_id),
+       queued - qmgr got message (from, size, nrcpt),
+       delivery - smtp/lmtp/local/virtual/pipe/error (to, domain, relay,
+       delay, delay_before, delay_queue, delay_conn, delay_xmit, dsn,
+       status, reason),
+       expired, removed - qmgr; reject - cleanup/milter reject (reason).
+       Links of messages (see getLinks) are built with segment and kept
+       near it (.lk), so trace does not read segments.
+    '''
+
+    STR_COLS = ['id', 'event', 'service', 'client', 'message_id', 'from',
+                'to', 'domain', 'relay', 'dsn', 'status', 'reason']
+    NUM_COLS = {'time': 'd', 'size': 'q', 'nrcpt': 'q', 'delay': 'f',
+                'delay_before': 'f', 'delay_queue': 'f',
+                'delay_conn': 'f', 'delay_xmit': 'f'}
+    DELAYS = ['delay_before', 'delay_queue', 'delay_conn', 'delay_xmit']
+    TIME_GROUPS = {'hour': '%Y-%m-%d %H:00', 'day': '%Y-%m-%d'}
+    EVENTLINE = re.compile(rb'.* postfix[\w.-]*/(?:[\w.-]+/)*([\w.-]+)'
+                           rb'\[\d+\]: (\w+): (.*)')
+    KEYVAL = re.compile(r'(\w+)=(<[^>]*>|[^,]*)(?:, |$)')
+    STATUS = re.compile(r'(\w+)(?: \((.*)\))?$')
+    WHERE = re.compile(r'\s*(\w+)\s*(!=|!~|<=|>=|=|<|>|~)\s*(.*)$')
+    QUEUED_AS = re.compile(r'queued as (\w+)')
+
+    def __init__(self, postfix):
+        self.postfix = postfix
+        self.path = postfix.index_dir
+
+    def getSegmentPath(self, key):
+        '''Full path to segment of the file with key from getFileKey'''
+        return os.path.join(self.path, '%d-%d.ev' % (key[0], key[1]))
+
+    def getLinksPath(self, key):
+        '''Full path to link index of the file with key'''
+        return os.path.join(self.path, '%d-%d.lk' % (key[0], key[1]))
+
+    def newSegment(self):
+        seg = {'key': None, 'size': 0, 'tail': b'', 'rows': 0,
+               'times': (None, None), 'cols': {}, 'values': {}}
+        for c in self.STR_COLS:
+            seg['cols'][c] = array('I')
+            seg['values'][c] = []
+        for c, t in self.NUM_COLS.items():
+            seg['cols'][c] = array(t)
+        return seg
+
+    def loadSegment(self, path):
+        '''Load segment of log file, return tuple (key, segment),
+           segment is new (empty) if the file is changed,
+           see Postfix.loadIndex'''
+        key = self.postfix.getFileKey(path)
+        if key is None or self.path is None:
+            return (key, self.newSegment())
+        try:
+            with open(self.getSegmentPath(key), 'rb') as f:
+                seg = pickle.loads(zlib.decompress(f.read()))
+        except Exception:
+            return (key, self.newSegment())
+        if self.postfix.getIndexedSize(path, key, seg['key'], seg['size'],
+                                       seg['tail']) == 0:
+            return (key, self.newSegment())
+        return (key, seg)
+
+    def saveSegment(self, key, seg):
+        self.dump(self.getSegmentPath(key), seg)
+
+    def dump(self, spath, obj):
+        '''Save compressed pickle of obj to file spath'''
+        tmp = '%s.%d.tmp' % (spath, os.getpid())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(zlib.compress(pickle.dumps(
+                    obj, protocol=pickle.HIGHEST_PROTOCOL), 1))
+            os.replace(tmp, spath)
+        except Exception as e:
+            print(str(e))
+
+    def newLinks(self):
+        return {'key': None, 'size': 0, 'tail': b'', 'next': {},
+                'prev': {}, 'message_id': {}, 'ids': {}}
+
+    def loadLinks(self, path):
+        '''Load link index of log file (see getLinks),
+           return None if there is no valid one'''
+        key = self.postfix.getFileKey(path)
+        if key is None or self.path is None:
+            return None
+        try:
+            with open(self.getLinksPath(key), 'rb') as f:
+                links = pickle.loads(zlib.decompress(f.read()))
+        except Exception:
+            return None
+        if self.postfix.getIndexedSize(path, key, links['key'],
+                                       links['size'], links['tail']) == 0:
+            return None
+        return links
+
+    def addLink(self, links, ev):
+        '''Add links of event to link index of the file'''
+        mid = ev['id']
+        if ev['event'] == 'message-id':
+            msgid = ev.get('message_id', '')
+            links['message_id'][mid] = msgid
+            if msgid not in links['ids'].keys():
+                links['ids'][msgid] = set()
+            links['ids'][msgid].add(mid)
+        elif ev['event'] == 'delivery':
+            m = self.QUEUED_AS.search(ev.get('reason', ''))
+            if m is None or m.group(1) == mid:
+                return
+            nid = m.group(1)
+            if mid not in links['next'].keys():
+                links['next'][mid] = set()
+            links['next'][mid].add(nid)
+            if nid not in links['prev'].keys():
+                links['prev'][nid] = set()
+            links['prev'][nid].add(mid)
+
+    def buildLinks(self, seg):
+        '''Return link index of the file from its segment (for segment
+           saved without it)'''
+        links = self.newLinks()
+        links['key'] = seg['key']
+        links['size'] = seg['size']
+        links['tail'] = seg['tail']
+        if seg['rows'] == 0:
+            return links
+        values = seg['values']
+        cols = seg['cols']
+        ev_codes = dict((v, i) for i, v in enumerate(values['event']))
+        mcode = ev_codes.get('message-id')
+        dcode = ev_codes.get('delivery')
+        for i in range(seg['rows']):
+            e = cols['event'][i]
+            if e == mcode:
+                self.addLink(links, {
+                    'id': values['id'][cols['id'][i]],
+                    'event': 'message-id',
+                    'message_id': values['message_id'][
+                        cols['message_id'][i]]})
+            elif e == dcode:
+                self.addLink(links, {
+                    'id': values['id'][cols['id'][i]],
+                    'event': 'delivery',
+                    'reason': values['reason'][cols['reason'][i]]})
+        return links
+
+    def parseLine(self, line, mtime):
+        '''Return event of raw log line as dict or None'''
+        m = self.EVENTLINE.match(line)
+        if m is None:
+            return None
+        service = m.group(1).decode('ascii', 'replace')
+        text = m.group(3).decode('utf-8', 'replace').rstrip('\n')
+        ev = {'id': m.group(2).decode('ascii'), 'service': service}
+        if text == 'removed':
+            ev['event'] = 'removed'
+        elif text.startswith('client='):
+            ev['event'] = 'client'
+            ev['client'] = text[7:].split(',')[0]
+        elif text.startswith('message-id='):
+            ev['event'] = 'message-id'
+            ev['message_id'] = text[11:].strip('<>')
+        elif 'reject: ' in text[:20]:
+            ev['event'] = 'reject'
+            ev['reason'] = text.split(': ', 2)[-1]
+        else:
+            kv = dict((k, v.strip('<>')) for k, v in
+                      self.KEYVAL.findall(text))
+            if 'to' in kv.keys():
+                ev['event'] = 'delivery'
+                ev['to'] = kv['to']
+                ev['domain'] = kv['to'].rpartition('@')[2].lower()
+                for k in ('relay', 'dsn'):
+                    if k in kv.keys():
+                        ev[k] = kv[k]
+                try:
+                    ev['delay'] = float(kv['delay'])
+                    for k, v in zip(self.DELAYS, kv['delays'].split('/')):
+                        ev[k] = float(v)
+                except (KeyError, ValueError):
+                    pass
+                st = text.find('status=')
+                if st >= 0:
+                    sm = self.STATUS.match(text[st + 7:])
+                    if sm:
+                        ev['status'] = sm.group(1)
+                        if sm.group(2) is not None:
+                            ev['reason'] = sm.group(2)
+            elif 'from' in kv.keys():
+                if 'expired' in text:
+                    ev['event'] = 'expired'
+                else:
+                    ev['event'] = 'queued'
+                ev['from'] = kv['from'] or 'MAILER-DAEMON'
+                for k in ('size', 'nrcpt'):
+                    try:
+                        ev[k] = int(kv[k].split()[0])
+                    except (KeyError, ValueError, IndexError):
+                        pass
+            else:
+                return None
+        t = self.postfix.getLineTime(line[:64].decode('utf-8', 'replace'),
+                                     mtime)
+        ev['time'] = t.timestamp() if t is not None else float('nan')
+        return ev
+
+    def addEvent(self, seg, codes, ev):
+        '''Append event to columns of the segment,
+           codes - {column: {value: code}}'''
+        cols = seg['cols']
+        for c in self.STR_COLS:
+            v = ev.get(c, '')
+            code = codes[c].get(v)
+            if code is None:
+                code = len(seg['values'][c])
+                seg['values'][c].append(v)
+                codes[c][v] = code
+            cols[c].append(code)
+        for c, t in self.NUM_COLS.items():
+            cols[c].append(ev.get(c, -1 if t == 'q' else float('nan')))
+        seg['rows'] += 1
+        t = ev['time']
+        if t == t:
+            lo, hi = seg['times']
+            seg['times'] = (t if lo is None or t < lo else lo,
+                            t if hi is None or t > hi else hi)
+
+    def updateFile(self, path):
+        '''Parse new lines of log file to its segment and save it,
+           return number of rows in segment'''
+        key, seg = self.loadSegment(path)
+        if key is None:
+            return 0
+        if seg['size'] > 0 and (self.postfix.isCompressed(path) or
+                                seg['size'] == key[2]):
+            return seg['rows']
+        f = self.postfix.getFileHandler(path)
+        if f is None:
+            return seg['rows']
+        codes = dict((c, dict((v, i) for i, v in
+                              enumerate(seg['values'][c])))
+                     for c in self.STR_COLS)
+        links = self.loadLinks(path)
+        if links is None or links['size'] != seg['size']:
+            links = self.buildLinks(seg)
+        mtime = datetime.datetime.fromtimestamp(key[3])
+        f.seek(seg['size'])
+        fpos = seg['size']
+        tail = b''
+        rows = seg['rows']
+        nlines = 0
+        for line in f:
+            if line[-1:] != b'\n':
+                break
+            nlines += 1
+            ev = self.parseLine(line, mtime)
+            if ev is not None:
+                self.addEvent(seg, codes, ev)
+                self.addLink(links, ev)
+            fpos = f.tell()
+            tail = line
+        f.close()
+        ScanStats.add(bytes=fpos - seg['size'], lines=nlines,
+                      matches=seg['rows'] - rows)
+        if fpos > seg['size']:
+            seg['key'] = key
+            seg['size'] = fpos
+            seg['tail'] = tail[-64:]
+            # links are saved first: links older than segment would be
+            # used by trace, newer ones are built again by updateFile
+            links['key'] = key
+            links['size'] = fpos
+            links['tail'] = seg['tail']
+            self.dump(self.getLinksPath(key), links)
+            self.saveSegment(key, seg)
+        return seg['rows']
+
+    def update(self):
+        '''Update segments of all log files, return list of files'''
+        t = self.postfix.startTiming()
+        gf = self.postfix.getFiles()
+        self.postfix.cleanIndex(gf, ext='.ev')
+        self.postfix.cleanIndex(gf, ext='.lk')
+        for path, rows in self.postfix.imap(self.updateFile, gf):
+            pass
+        self.postfix.addTiming('events', t)
+        return gf
+
+    def getLinks(self, files=None):
+        '''Return list of link indexes of files (updated with segments,
+           see updateFile): {'next': {MsgID: set(MsgID)},
+           'prev': {MsgID: set(MsgID)}, 'message_id': {MsgID: message_id},
+           'ids': {message_id: set(MsgID)}}
+           next - "queued as NEW_ID" in reply of relay (content filter
+           or the next hop on this host), prev - reverse of next,
+           messages with the same message_id are the same message.
+        '''
+        if files is None:
+            files = self.postfix.getFiles()
+        res = []
+        for path in files:
+            links = self.loadLinks(path)
+            if links is None:
+                key, seg = self.loadSegment(path)
+                if seg['rows'] == 0:
                     continue
-                elif line == '\n':
-                    if self.isFilter(rec,
-                                     mindate,
-                                     maxdate,
-                                     from_regex,
-                                     to_regex):
-                        if delete:
-                            rec['deleted'] = self.dropMessage(pmid)
-                        rec['time'] = rec['time'].isoformat(' ')
-                        mq[pmid] = rec
-                        rec = {}
-                        pmid = ''
-                    else:
-                        rec = {}
-                        pmid = ''
-                        continue
+                links = self.buildLinks(seg)
+                if key is not None and self.path is not None:
+                    self.dump(self.getLinksPath(key), links)
+            if links['next'] or links['message_id']:
+                res.append(links)
+        return res
+
+    def getLinked(self, links, name, key):
+        '''Return union of sets of key in map name of all link indexes'''
+        res = set()
+        for i in links:
+            res.update(i[name].get(key, ()))
+        return res
+
+    def trace(self, pmid, links):
+        '''Follow links (see getLinks) from message pmid in both
+           directions, return chain of messages [{id, parent, via},],
+           via - queued-as (parent passed message to id), queued-from
+           (id passed message to parent) or message-id'''
+        chain = [{'id': pmid, 'parent': None, 'via': None}]
+        seen = set([pmid])
+        pos = 0
+        while pos < len(chain):
+            cur = chain[pos]['id']
+            pos += 1
+            linked = [(i, 'queued-as') for i in
+                      sorted(self.getLinked(links, 'next', cur))]
+            linked += [(i, 'queued-from') for i in
+                       sorted(self.getLinked(links, 'prev', cur))]
+            # message_id of the last file as queue ID may be reused
+            msgid = None
+            for i in reversed(links):
+                msgid = i['message_id'].get(cur)
+                if msgid is not None:
+                    break
+            if msgid:
+                linked += [(i, 'message-id') for i in
+                           sorted(self.getLinked(links, 'ids', msgid))]
+            for i, via in linked:
+                if i not in seen:
+                    seen.add(i)
+                    chain.append({'id': i, 'parent': cur, 'via': via})
+        return chain
+
+    def parseWhere(self, where):
+        '''Parse filter FIELD OP VALUE, return (field, function),
+           function is called with value of the field'''
+        m = self.WHERE.match(where)
+        if m is None:
+            raise ValueError('Can not parse condition "%s"' % where)
+        field, op, value = m.groups()
+        if field in self.STR_COLS:
+            if op in ('~', '!~'):
+                reg = re.compile(value)
+                f = (lambda x: reg.search(x) is not None)
+            elif op in ('=', '!='):
+                f = (lambda x: x == value)
+            else:
+                raise ValueError('Operator "%s" is not supported for "%s"' %
+                                 (op, field))
+            if op[0] == '!':
+                return (field, lambda x: not f(x))
+            return (field, f)
+        if field in self.NUM_COLS.keys():
+            v = float(value)
+            cmp = {'=': lambda x: x == v, '!=': lambda x: x != v,
+                   '<': lambda x: x < v, '<=': lambda x: x <= v,
+                   '>': lambda x: x > v, '>=': lambda x: x >= v}
+            if op not in cmp.keys():
+                raise ValueError('Operator "%s" is not supported for "%s"' %
+                                 (op, field))
+            return (field, cmp[op])
+        raise ValueError('Unknown field "%s"' % field)
+
+    def query(self, group_by, where=[], top=10, since=None, until=None,
+              files=None):
+        '''Count events grouped by columns (list, hour and day are
+           groups by time), where - list of conditions FIELD OP VALUE
+           (see parseWhere), since, until - datetime.
+           Return list of top groups [{column: value, count: N},]
+           sorted by count.
+        '''
+        for c in group_by:
+            if c not in self.STR_COLS and c not in self.TIME_GROUPS.keys():
+                raise ValueError('Can not group by "%s"' % c)
+        conds = [self.parseWhere(w) for w in where]
+        lo = since.timestamp() if since is not None else None
+        hi = until.timestamp() if until is not None else None
+        if files is None:
+            files = self.postfix.getFiles()
+        counts = {}
+        for path in files:
+            key, seg = self.loadSegment(path)
+            if seg['rows'] == 0:
+                continue
+            first, last = seg['times']
+            if (lo is not None and last is not None and last < lo) or \
+                    (hi is not None and first is not None and first > hi):
+                continue
+            cols = seg['cols']
+            rows = range(seg['rows'])
+            if lo is not None or hi is not None:
+                tc = cols['time']
+                rows = [i for i in rows if
+                        (lo is None or tc[i] >= lo) and
+                        (hi is None or tc[i] <= hi)]
+            for field, f in conds:
+                col = cols[field]
+                if field in self.STR_COLS:
+                    # condition is checked once per distinct value
+                    ok = set(i for i, v in enumerate(seg['values'][field])
+                             if f(v))
+                    rows = [i for i in rows if col[i] in ok]
+                else:
+                    rows = [i for i in rows if f(col[i])]
+            gcols = []
+            for c in group_by:
+                if c in self.TIME_GROUPS.keys():
+                    gcols.append(cols['time'])
                 else:
-                    fl_result = fl_re.match(line)
-                    msg_result = msg_re.match(line)
-                    toaddr_result = toaddr_re.match(line)
-                    if fl_result:
-                        pmid = fl_result.group(1)
-                        rec['size'] = int(fl_result.group(2))
-                        rec['time'] = datetime.datetime.strptime(fl_result.group(3),
-                                                                 '%a %b %d %H:%M:%S')
-                        n = datetime.datetime.now()
-                        rec['time'] = rec['time'].replace(n.year)
-                        if rec['time'] > n:
-                            rec['time'].replace(n.year - 1)
-                        rec['from'] = fl_result.group(4)
-                    elif msg_result:
-                        rec['message'] = msg_result.group(1)
-                    elif toaddr_result:
-                        if 'to' in rec.keys():
-                            rec['to'].append(toaddr_result.group(1))
-                        else:
-                            rec['to'] = []
-                            rec['to'].append(toaddr_result.group(1))
+                    gcols.append(cols[c])
+            seg_counts = {}
+            for i in rows:
+                k = tuple(col[i] for col in gcols)
+                seg_counts[k] = seg_counts.get(k, 0) + 1
+            for k, n in seg_counts.items():
+                values = []
+                for c, v in zip(group_by, k):
+                    if c in self.TIME_GROUPS.keys():
+                        values.append(
+                            datetime.datetime.fromtimestamp(v).strftime(
+                                self.TIME_GROUPS[c]) if v == v else '')
                     else:
-                        unparsed.append(line)
-        mq['unparsed'] = unparsed
-        return mq
+                        values.append(seg['values'][c][v])
+                values = tuple(values)
+                counts[values] = counts.get(values, 0) + n
+        res = []
+        for k, n in sorted(counts.items(), key=lambda i: (-i[1], i[0])):
+            if top and len(res) >= top:
+                break
+            r = dict(zip(group_by, k))
+            r['count'] = n
+            res.append(r)
+        return res
+
+
+def parseTime(value):
+    '''Parse date|time from command line: %Y-%m-%d %H:%M:%S,
+       %Y-%m-%d or N[mhd] - N minutes, hours, days ago; None - None'''
+    if value is None:
+        return None
+    m = re.match(r'^(\d+)([mhd])$', value)
+    if m:
+        delta = {'m': 'minutes', 'h': 'hours', 'd': 'days'}[m.group(2)]
+        return datetime.datetime.now() - \
+            datetime.timedelta(**{delta: int(m.group(1))})
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Wrong date|time: %s' % value)
+
+
+class LogFollower:
+    '''Follow (tail -F) the live log file and keep in memory lines of the
+       last max_ids messages, answer queries over Unix socket with the
+       same result as Postfix.getPostfixMailLogs / getPostfixMailLogsByID.
+       Request and answer are one JSON object per line:
+       {"regex": [regex, ]} -> {regex: {MsgID: [lines]}}
+       {"id": [MsgID, ]} -> {MsgID: [lines]}
+    '''
+
+    def __init__(self, postfix, path, max_ids=100000, interval=1.0):
+        self.postfix = postfix
+        self.path = path
+        self.max_ids = max_ids
+        self.interval = interval
+        self.postfixline = re.compile(postfix.postfixloglinereg)
+        self.msgs = OrderedDict()
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+
+    def addLine(self, line):
+        plr = self.postfixline.match(line)
+        if not plr:
+            return
+        mid = plr.group(1)
+        with self.lock:
+            if mid in self.msgs.keys():
+                self.msgs.move_to_end(mid)
+            else:
+                self.msgs[mid] = []
+                if len(self.msgs) > self.max_ids:
+                    self.msgs.popitem(last=False)
+            self.msgs[mid].append(line)
+
+    def follow(self):
+        '''Read the file from the start and then wait for new lines,
+           the file is reopened when it is rotated (inode is changed)
+           or truncated'''
+        f = None
+        ino = None
+        buf = b''
+        while not self.stop.is_set():
+            if f is None:
+                try:
+                    f = open(self.path, mode='rb')
+                    ino = os.fstat(f.fileno()).st_ino
+                except Exception:
+                    f = None
+                    self.stop.wait(self.interval)
+                    continue
+            data = f.readline()
+            if data:
+                buf += data
+                if buf[-1:] == b'\n':
+                    self.addLine(buf.decode('utf-8', 'replace'))
+                    buf = b''
+                continue
+            try:
+                st = os.stat(self.path)
+            except Exception:
+                st = None
+            if st is None or st.st_ino != ino:
+                # rotated: the old file is read up to the end already
+                f.close()
+                f = None
+                buf = b''
+                continue
+            if st.st_size < f.tell():
+                f.seek(0)
+                buf = b''
+                continue
+            self.stop.wait(self.interval)
+        if f is not None:
+            f.close()
+
+    def query(self, req):
+        '''Answer request (dict), see class description'''
+        with self.lock:
+            msgs = [(mid, list(lines)) for mid, lines in self.msgs.items()]
+        if 'id' in req.keys():
+            ids = set(req['id'])
+            return dict([i for i in msgs if i[0] in ids])
+        mr = MultiRegex(req.get('regex', []))
+        res = {}
+        for mid, lines in msgs:
+            found = set()
+            for line in lines:
+                found.update(mr.match(line))
+            for reg in found:
+                if reg not in res.keys():
+                    res[reg] = {}
+                res[reg][mid] = lines
+        return res
+
+    def serve(self, socket_path):
+        '''Follow the file in thread and answer queries on Unix socket
+           until KeyboardInterrupt'''
+        follower = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        res = follower.query(json.loads(line.decode('utf-8')))
+                    except Exception as e:
+                        res = {'error': str(e)}
+                    self.wfile.write(
+                        ('%s\n' % json.dumps(res)).encode('utf-8'))
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        server.daemon_threads = True
+        th = threading.Thread(target=self.follow, daemon=True)
+        th.start()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop.set()
+            server.server_close()
+            os.remove(socket_path)
+            th.join()
+
+
+def queryFollower(socket_path, req):
+    '''Send request (dict) to LogFollower over Unix socket,
+       return answer'''
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(socket_path)
+    f = s.makefile('rwb')
+    f.write(('%s\n' % json.dumps(req)).encode('utf-8'))
+    f.flush()
+    res = json.loads(f.readline().decode('utf-8'))
+    f.close()
+    s.close()
+    return res
+
+
+def formatStats(stats, fmt='json'):
+    '''Return statistics of Postfix.getStats as JSON or Prometheus text
+       (for node_exporter textfile collector)'''
+    if fmt == 'json':
+        return json.dumps({'stats': stats}, indent=4, sort_keys=True)
+
+    def label(v):
+        return str(v).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+
+    lines = []
+
+    def metric(name, text, values):
+        lines.append('# HELP postmgr_%s %s' % (name, text))
+        lines.append('# TYPE postmgr_%s gauge' % name)
+        for labels, v in values:
+            lines.append('postmgr_%s{%s} %r' % (
+                name, ','.join('%s="%s"' % (k, label(lv))
+                               for k, lv in labels), float(v)))
+
+    for kind in ('wall', 'cpu'):
+        metric('phase_%s_seconds' % kind, '%s time of phase' % kind,
+               [([('phase', phase)], v[kind])
+                for phase, v in sorted(stats['phases'].items())])
+    units = [('calls', 'calls', 'calls of worker functions'),
+             ('wall', 'wall_seconds', 'wall time in workers'),
+             ('cpu', 'cpu_seconds', 'cpu time in workers'),
+             ('decompress_cpu', 'decompress_cpu_seconds',
+              'cpu time of external decompressors'),
+             ('read', 'read_bytes', 'bytes read with I/O limit'),
+             ('bytes', 'scanned_bytes', 'uncompressed bytes scanned'),
+             ('lines', 'lines', 'lines scanned'),
+             ('matches', 'matches', 'lines matched by regex')]
+    for group, name in (('files', 'file'), ('workers', 'worker')):
+        for field, unit, text in units:
+            metric('%s_%s' % (name, unit), '%s per %s' % (text, name),
+                   [([(name, k)], v[field])
+                    for k, v in sorted(stats[group].items())])
+    metric('peak_rss_bytes', 'peak resident set size',
+           [([('process', k)], v)
+            for k, v in sorted(stats['peak_rss'].items())])
+    return '\n'.join(lines) + '\n'
+
+
+def saveStats(postfix, path, fmt='json'):
+    '''Stop workers and write statistics of the run (Postfix.getStats)
+       to file path (replaced atomically) or to stderr if path is -'''
+    postfix.close()
+    text = formatStats(postfix.getStats(), fmt)
+    if path == '-':
+        sys.stderr.write(text)
+        return
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp, encoding='utf-8', mode='w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except Exception as e:
+        print(str(e))
+
+
+class NDJSONWriter:
+    '''Write result as stream of JSON objects - one object per line
+       (http://ndjson.org), to stdout and/or to file (may be gzipped),
+       every object is written as soon as it is ready.
+    '''
+
+    def __init__(self, fname=None, stdout=True, compress=False):
+        self.stdout = stdout
+        self.count = 0
+        self.f = None
+        if fname is not None:
+            if compress:
+                self.f = gzip.open(fname, mode='wt', encoding='utf-8')
+            else:
+                self.f = open(fname, encoding='utf-8', mode='w+')
+
+    def write(self, obj):
+        '''Write one object'''
+        line = '%s\n' % json.dumps(obj, sort_keys=True)
+        if self.stdout:
+            sys.stdout.write(line)
+        if self.f is not None:
+            self.f.write(line)
+        self.count += 1
+
+    def writeRecord(self, pmid, rec):
+        '''Write record of mail queue, see Postfix.queueMng'''
+        obj = {'id': pmid}
+        obj.update(rec)
+        self.write(obj)
+
+    def close(self):
+        if self.stdout:
+            sys.stdout.flush()
+        if self.f is not None:
+            self.f.close()
+            self.f = None
 
 
 if __name__ == '__main__':  # main
     import argparse
-    import json
+    import atexit
+    import signal
     opt = argparse.ArgumentParser(description=__doc__,
                                   epilog='version: %s' % __version__)
     opt.add_argument('--mailqpath',
@@ -355,6 +3434,27 @@ if __name__ == '__main__':  # main
                      default='postsuper',
                      help=('Full path to postsuper binary '
                            '(default: %(default)s)'))
+    opt.add_argument('--postqueuepath',
+                     dest='postqueuepath',
+                     default='postqueue',
+                     help=('Full path to postqueue binary '
+                           '(default: %(default)s)'))
+    opt.add_argument('--queue-backend',
+                     dest='queue_backend',
+                     default='auto',
+                     choices=['auto', 'json', 'text', 'dir'],
+                     help=('How to read mail queue: json - postqueue -j '
+                           '(Postfix >= 3.1), text - parse mailq output, '
+                           'dir - read queue files from --queue-dir, '
+                           'auto - json if supported (default: '
+                           '%(default)s)'))
+    opt.add_argument('--queue-dir',
+                     dest='queue_dir',
+                     default='/var/spool/postfix',
+                     help=('Postfix queue_directory for --queue-backend '
+                           'dir, parsed queue files are cached only with '
+                           '-i/--index-dir (in it), otherwise all files are '
+                           'parsed on every run (default: %(default)s)'))
     opt.add_argument('--log-mask',
                      dest='log_mask',
                      default='mail.info*',
@@ -383,17 +3483,133 @@ if __name__ == '__main__':  # main
                      default=None,
                      help=('RegEx for filter message by recipient in '
                            'queue (default: %(default)s)'))
+    opt.add_argument('--filter',
+                     dest='filter',
+                     default=None,
+                     help=('Filter expression for messages in queue, e.g. '
+                           '\'size>1m and (domain=example.com or '
+                           'reason~"timed out") and not flag=!\', fields: '
+                           'size, age, time, from, to, domain, message '
+                           '(reason), queue, flag (default: %(default)s)'))
+    opt.add_argument('--histogram',
+                     dest='histogram',
+                     default=None,
+                     choices=['json', 'nagios', 'munin', 'munin-config'],
+                     help=('Return only histograms of (filtered) mail queue '
+                           'in one pass: number of messages by age, size, '
+                           'queue, destination domain and deferral reason '
+                           '(--top of domains and reasons), as json, Nagios '
+                           'plugin output with perfdata or munin multigraph '
+                           'values/config (default: %(default)s)'))
+    opt.add_argument('--hist-keys',
+                     dest='hist_keys',
+                     type=int,
+                     default=100,
+                     help=('Maximum number of counted domains and reasons '
+                           'of --histogram (memory does not depend on size '
+                           'of queue) (default: %(default)s)'))
+    opt.add_argument('--warning',
+                     dest='warning',
+                     type=int,
+                     default=None,
+                     help=('Number of messages in queue for WARNING state '
+                           'of --histogram nagios (default: %(default)s)'))
+    opt.add_argument('--critical',
+                     dest='critical',
+                     type=int,
+                     default=None,
+                     help=('Number of messages in queue for CRITICAL state '
+                           'of --histogram nagios (default: %(default)s)'))
     opt.add_argument('--regex',
                      dest='regex',
                      default=None,
                      action='append',
                      help=('RegEx for filter message by in '
                            'logs (default: %(default)s)'))
+    opt.add_argument('--since',
+                     dest='since',
+                     default=None,
+                     help=('Parse only log lines from this date|time or '
+                           'for last N[mhd] (minutes, hours, days), log '
+                           'files out of range are skipped (default: '
+                           '%(default)s)'))
+    opt.add_argument('--until',
+                     dest='until',
+                     default=None,
+                     help=('Parse only log lines up to this date|time or '
+                           'N[mhd] ago (default: %(default)s)'))
+    opt.add_argument('--follow',
+                     dest='follow',
+                     action='store_true',
+                     help=('If used (True) - run as daemon: follow the live '
+                           'log file, keep recent messages in memory and '
+                           'answer --regex queries on --socket (default: '
+                           '%(default)s)'))
+    opt.add_argument('--socket',
+                     dest='socket',
+                     default=None,
+                     help=('Unix socket of --follow daemon, if used with '
+                           '--regex - ask the daemon instead of parsing '
+                           'logs (default: %(default)s)'))
+    opt.add_argument('--follow-file',
+                     dest='follow_file',
+                     default=None,
+                     help=('Log file to follow (default: %(default)s - '
+                           'the last modified uncompressed file in LOG_DIR)'))
+    opt.add_argument('--follow-ids',
+                     dest='follow_ids',
+                     type=int,
+                     default=100000,
+                     help=('Number of recent messages kept in memory by '
+                           '--follow daemon (default: %(default)s)'))
+    opt.add_argument('--events',
+                     dest='events',
+                     action='store_true',
+                     help=('If used (True) - update store of postfix events '
+                           'parsed from logs (in --index-dir) and count '
+                           'events by --group-by (default: %(default)s)'))
+    opt.add_argument('--group-by',
+                     dest='group_by',
+                     default='status',
+                     help=('Comma separated columns to group --events by: '
+                           '%s, hour, day (default: %%(default)s)' %
+                           ', '.join(EventStore.STR_COLS)))
+    opt.add_argument('--where',
+                     dest='where',
+                     action='append',
+                     default=[],
+                     help=('Condition FIELD OP VALUE for --events, OP is '
+                           '= != ~ !~ for strings and = != < <= > >= for '
+                           'numbers (time, size, nrcpt, delay, delay_*), '
+                           'can be used several times (default: '
+                           '%(default)s)'))
+    opt.add_argument('--top',
+                     dest='top',
+                     type=int,
+                     default=10,
+                     help=('Number of the biggest groups of --events, 0 - '
+                           'all (default: %(default)s)'))
+    opt.add_argument('--trace',
+                     dest='trace',
+                     action='append',
+                     default=None,
+                     help=('Message ID to trace: follow "queued as" replies '
+                           'of relays (content filters) and message-id '
+                           'links in both directions by the events store '
+                           '(see --events) and return log lines of all '
+                           'messages of the chain, can be used several '
+                           'times (default: %(default)s)'))
     opt.add_argument('-d', '--del',
                      dest='delete',
                      action='store_true',
                      help=('If used (True) - delete filtered messages '
                            'from queue (default: %(default)s)'))
+    opt.add_argument('--del-batch',
+                     dest='delete_batch',
+                     type=int,
+                     default=1000,
+                     help=('Number of messages deleted by one postsuper '
+                           'process (default: %(default)s)'))
     opt.add_argument('-s', '--save',
                      dest='save',
                      action='store_true',
@@ -420,47 +3636,316 @@ if __name__ == '__main__':  # main
                      action='store_true',
                      help=('If used (True) - save result as gzipped json '
                            '(default: %(default)s)'))
+    opt.add_argument('-l', '--ndjson',
+                     dest='ndjson',
+                     action='store_true',
+                     help=('If used (True) - write result as stream of json '
+                           'objects, one per line and message, saved file '
+                           'is %(prog)s_DATE_log.ndjson (default: '
+                           '%(default)s)'))
     opt.add_argument('-o', '--one-proc',
                      dest='multiproc',
                      action='store_false',
                      help=('If used (False) - do not use multiprocessing'
                            '(default: %(default)s)'))
+    opt.add_argument('-w', '--workers',
+                     dest='workers',
+                     type=int,
+                     default=None,
+                     help=('Number of worker processes (default: '
+                           '%(default)s - number of CPUs)'))
+    opt.add_argument('--stats',
+                     dest='stats',
+                     default=None,
+                     help=('Write statistics of the run to file STATS '
+                           '(- is stderr): wall and cpu time of phases, '
+                           'time, bytes, lines and matches per file and '
+                           'per worker, peak RSS (default: %(default)s)'))
+    opt.add_argument('--stats-format',
+                     dest='stats_format',
+                     default='json',
+                     choices=['json', 'prometheus'],
+                     help=('Format of --stats: json or prometheus text '
+                           '(for node_exporter textfile collector) '
+                           '(default: %(default)s)'))
+    opt.add_argument('--io-limit',
+                     dest='io_limit',
+                     type=float,
+                     default=0,
+                     help=('Max rate (MB/s) of reading log files by all '
+                           'workers, achieved rate is printed to stderr, '
+                           '0 - no limit (default: %(default)s)'))
+    opt.add_argument('--nice',
+                     dest='nice',
+                     type=int,
+                     default=0,
+                     help=('Add to nice value (lower CPU priority) of '
+                           'postmgr and workers (default: %(default)s)'))
+    opt.add_argument('--idle-io',
+                     dest='idle_io',
+                     action='store_true',
+                     help=('Idle I/O scheduling class (ioprio_set), disk '
+                           'is read only when nobody else needs it '
+                           '(default: %(default)s)'))
+    opt.add_argument('--low-impact',
+                     dest='low_impact',
+                     action='store_true',
+                     help=('Search on busy server: --nice 19 --idle-io '
+                           'and one worker if --nice and -w are not set '
+                           '(default: %(default)s)'))
     opt.add_argument('-n', '--noindex',
                      dest='noindex',
                      action='store_true',
                      help=('If used (True) - no index log files, '
                            'use less memory (default: %(default)s)'))
+    opt.add_argument('--chunk-size',
+                     dest='chunk_size',
+                     type=int,
+                     default=256,
+                     help=('Uncompressed log files bigger than this (MB) '
+                           'are split to parts parsed by different '
+                           'processes, 0 - do not split (default: '
+                           '%(default)s)'))
+    opt.add_argument('-g', '--gz-gather',
+                     dest='gather',
+                     action='store_true',
+                     help=('If used (True) - gather lines of found messages '
+                           'while compressed log files are parsed, so they '
+                           'are decompressed only once, use more memory '
+                           '(default: %(default)s)'))
+    opt.add_argument('-i', '--persist-index',
+                     dest='persist_index',
+                     action='store_true',
+                     help=('If used (True) - keep index of log files '
+                           'between runs in --index-dir, only new lines '
+                           'are indexed on next run (default: %(default)s)'))
+    opt.add_argument('--index-dir',
+                     dest='index_dir',
+                     default=None,
+                     help=('Directory for persistent index of log files, '
+                           'if used - the same as -i (default: %(default)s '
+                           '- LOG_DIR/.postmgr with -i)'))
+    opt.add_argument('--cache-size',
+                     dest='cache_size',
+                     default=64,
+                     type=int,
+                     help=('Max size (MB) of cache of --regex results in '
+                           '--index-dir, results for unchanged log files '
+                           'are taken from it, 0 - do not cache '
+                           '(default: %(default)s)'))
+    opt.add_argument('--decompress',
+                     dest='decompress',
+                     default='auto',
+                     choices=['auto', 'internal', 'external'],
+                     help=('How to read compressed (gz, bz2, xz, zst) log '
+                           'files: internal - python modules, external - '
+                           'pigz/gzip, pbzip2/lbzip2/bzip2, xz -T0, zstd '
+                           '-T0, auto - '
+                           'external if installed (default: %(default)s)'))
+    opt.add_argument('--engine',
+                     dest='engine',
+                     default='auto',
+                     choices=['auto', 'mmap', 'lines'],
+                     help=('How to scan uncompressed log files: mmap - '
+                           'search regex in memory map of the whole file '
+                           '(rotated files, the live file is read by lines), '
+                           'lines - line by line, auto - mmap '
+                           '(default: %(default)s)'))
+    opt.add_argument('--decode-errors',
+                     dest='decode_errors',
+                     default='replace',
+                     choices=['strict', 'replace', 'ignore',
+                              'backslashreplace', 'surrogateescape'],
+                     help=('How to decode found log lines with invalid '
+                           'UTF-8, strict - stop with error '
+                           '(default: %(default)s)'))
 
     options = opt.parse_args()
+    if (options.persist_index or options.events or options.trace) and \
+            options.index_dir is None:
+        options.index_dir = os.path.join(options.log_dir, '.postmgr')
+    if options.low_impact:
+        options.idle_io = True
+        if options.nice == 0:
+            options.nice = 19
+        if options.workers is None:
+            options.workers = 1
+    # workers and decompressors inherit priority
+    setPriority(nice=options.nice, idle_io=options.idle_io)
 
     p = Postfix(mailq=options.mailqpath,
                 postsuper=options.pspath,
+                postqueue=options.postqueuepath,
+                queue_backend=options.queue_backend,
+                queue_dir=options.queue_dir,
+                delete_batch=options.delete_batch,
                 log_mask=options.log_mask,
                 log_dir=options.log_dir,
                 multiprocess=options.multiproc,
-                noindex=options.noindex)
-    if options.regex is not None:
+                noindex=options.noindex,
+                index_dir=options.index_dir,
+                chunk_size=options.chunk_size * 1024 * 1024,
+                gather=options.gather,
+                decode_errors=options.decode_errors,
+                decompress=options.decompress,
+                engine=options.engine,
+                cache_size=options.cache_size * 1024 * 1024,
+                io_limit=int(options.io_limit * 1024 * 1024),
+                stats=options.stats is not None,
+                workers=options.workers)
+    atexit.register(p.close)
+    if options.follow:
+        if options.socket is None:
+            opt.error('--follow requires --socket')
+        follow_file = options.follow_file or p.getLiveFile()
+        if follow_file is None:
+            opt.error('There is no log file to follow')
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        LogFollower(p, follow_file,
+                    max_ids=options.follow_ids).serve(options.socket)
+        sys.exit(0)
+    fdate = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    start = p.startTiming()
+    if options.mindate is not None:
+        mindate = datetime.datetime.strptime(options.mindate,
+                                             '%Y-%m-%d %H:%M:%S')
+    else:
+        mindate = None
+    if options.maxdate is not None:
+        maxdate = datetime.datetime.strptime(options.maxdate,
+                                             '%Y-%m-%d %H:%M:%S')
+    else:
+        maxdate = None
+    writer = None
+    if options.ndjson:
+        fname = None
+        if options.save:
+            fname = '%s_%s_log.ndjson' % (sys.argv[0], fdate)
+            if options.gzipjson:
+                fname = '%s.gz' % fname
+        writer = NDJSONWriter(fname=fname,
+                              stdout=not options.quiet,
+                              compress=options.gzipjson)
+    if options.events:
+        try:
+            since = parseTime(options.since)
+            until = parseTime(options.until)
+        except ValueError as e:
+            opt.error(str(e))
         if not options.json:
             print('Parsing logs...')
-        res = p.getPostfixMailLogs(options.regex)
+        store = EventStore(p)
+        try:
+            files = store.update()
+            t = p.startTiming()
+            res = store.query([c.strip() for c in options.group_by.split(',')
+                               if c.strip() != ''],
+                              where=options.where,
+                              top=options.top,
+                              since=since,
+                              until=until,
+                              files=files)
+            p.addTiming('query', t)
+        except (ValueError, re.error) as e:
+            opt.error(str(e))
+        out = p.startTiming()
+        if writer is not None:
+            for i in res:
+                writer.write(i)
+    elif options.trace is not None:
+        if not options.json:
+            print('Parsing logs...')
+        store = EventStore(p)
+        files = store.update()
+        t = p.startTiming()
+        links = store.getLinks(files)
+        p.addTiming('links', t)
+        res = {}
+        ids = []
+        for pmid in options.trace:
+            res[pmid] = {'chain': store.trace(pmid, links)}
+            ids.extend(i['id'] for i in res[pmid]['chain'])
+        # lines of all messages are read in one pass
+        logs = p.getPostfixMailLogsByID(sorted(set(ids)))
+        for pmid in res.keys():
+            res[pmid]['log'] = dict((i['id'], logs[i['id']])
+                                    for i in res[pmid]['chain']
+                                    if i['id'] in logs.keys())
+        out = p.startTiming()
+        if writer is not None:
+            for pmid in sorted(res.keys()):
+                writer.writeRecord(pmid, res.pop(pmid))
+    elif options.regex is not None:
+        try:
+            since = parseTime(options.since)
+            until = parseTime(options.until)
+        except ValueError as e:
+            opt.error(str(e))
+        if options.socket is not None:
+            res = queryFollower(options.socket, {'regex': options.regex})
+        else:
+            if not options.json:
+                print('Parsing logs...')
+            res = p.getPostfixMailLogs(options.regex, since=since,
+                                       until=until)
+        out = p.startTiming()
+        if writer is not None:
+            for reg in sorted(res.keys()):
+                for mid in sorted(res[reg].keys()):
+                    writer.write({'regex': reg,
+                                  'id': mid,
+                                  'log': res[reg].pop(mid)})
+    elif options.histogram is not None:
+        try:
+            flt = QueueFilter(expr=options.filter,
+                              mindate=mindate,
+                              maxdate=maxdate,
+                              from_regex=options.from_regex,
+                              to_regex=options.to_regex)
+        except (ValueError, re.error) as e:
+            opt.error('--filter: %s' % str(e))
+        t = p.startTiming()
+        hist = p.queueHistogram(flt, limit=options.hist_keys)
+        p.addTiming('queue', t)
+        out = p.startTiming()
+        if options.histogram != 'json':
+            state = 0
+            if options.histogram == 'nagios':
+                state, text = hist.nagios(options.top,
+                                          warning=options.warning,
+                                          critical=options.critical)
+                text += '\n'
+            else:
+                text = hist.munin(options.top,
+                                  config=options.histogram == 'munin-config')
+            sys.stdout.write(text)
+            if options.stats is not None:
+                p.addTiming('output', out)
+                p.addTiming('total', start)
+                saveStats(p, options.stats, options.stats_format)
+            sys.exit(state)
+        res = hist.result(options.top)
+        if writer is not None:
+            writer.write(res)
     else:
         if not options.json:
             print('Parsing mail queue...')
-        if options.mindate is not None:
-            mindate = datetime.datetime.strptime(options.mindate,
-                                                 '%Y-%m-%d %H:%M:%S')
-        else:
-            mindate = None
-        if options.maxdate is not None:
-            maxdate = datetime.datetime.strptime(options.maxdate,
-                                                 '%Y-%m-%d %H:%M:%S')
-        else:
-            maxdate = None
+        try:
+            QueueFilter(expr=options.filter)
+        except (ValueError, re.error) as e:
+            opt.error('--filter: %s' % str(e))
+        callback = None
+        if writer is not None and not options.fulllog:
+            callback = writer.writeRecord
+        t = p.startTiming()
         res = p.queueMng(mindate=mindate,
                          maxdate=maxdate,
                          from_regex=options.from_regex,
                          to_regex=options.to_regex,
-                         delete=options.delete)
+                         delete=options.delete,
+                         callback=callback,
+                         filter_expr=options.filter)
+        p.addTiming('queue', t)
         if options.fulllog:
             if not options.json:
                 print('Parsing logs...')
@@ -471,12 +3956,34 @@ if __name__ == '__main__':  # main
             for i in res.keys():
                 if i in logs.keys():
                     res[i]['log'] = logs[i]
+        out = p.startTiming()
+        if writer is not None:
+            for i in sorted(res.keys()):
+                if i != 'unparsed':
+                    writer.writeRecord(i, res.pop(i))
+            for line in res['unparsed']:
+                writer.write({'unparsed': line})
 
+    if options.io_limit:
+        elapsed = time.perf_counter() - start[0]
+        mb = p.getReadBytes() / 1048576.0
+        sys.stderr.write('Read %.1f MB of logs in %.1f s: %.2f MB/s '
+                         '(limit %.2f MB/s)\n' %
+                         (mb, elapsed, mb / max(elapsed, 1e-9),
+                          options.io_limit))
+    if writer is not None:
+        writer.close()
+        if options.stats is not None:
+            p.addTiming('output', out)
+            p.addTiming('total', start)
+            saveStats(p, options.stats, options.stats_format)
+        if not options.json:
+            print('\n Found %d records\n' % writer.count)
+        sys.exit(0)
     if not options.quiet:
         print(json.dumps(res, indent=4, sort_keys=True))
     if options.save:
-        fname = '%s_%s_log.json' % (sys.argv[0],
-                                    datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+        fname = '%s_%s_log.json' % (sys.argv[0], fdate)
         if options.gzipjson:
             fname = '%s.gz' % fname
             with gzip.open(fname, 'w') as f:
@@ -484,5 +3991,9 @@ if __name__ == '__main__':  # main
         else:
             with open(fname, encoding='utf-8', mode='w+') as f:
                 json.dump(res, f, indent=4, sort_keys=True)
+    if options.stats is not None:
+        p.addTiming('output', out)
+        p.addTiming('total', start)
+        saveStats(p, options.stats, options.stats_format)
     if not options.json:
         print('\n Found %d records\n' % len(res))
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks of postmgr.py (must be in the same directory or in sys.path).
+gen - write synthetic rotated Postfix log files (mail.info, mail.info.1,
+mail.info.2.gz, ...) to the directory.
+run - parse the log files in all modes (multiprocess on/off, index,
+--noindex, --fulllog), every mode in new process, report time of phases
+(getFiles, indexing, join, getPostfixMLLines), throughput and peak RSS.
+join - time of the join of found message IDs with index of log files
+(between two phases of Postfix.getPostfixMailLogs) for growing number
+of found IDs, time per ID must stay (about) the same.
+Results are printed as JSON, so they can be compared between releases.
+'''
+
+import sys
+import os
+import re
+import json
+import time
+import gzip
+import random
+import datetime
+import resource
+import subprocess
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from postmgr import (Postfix, OffsetIndex,  # noqa: E402
+                     __version__ as postmgr_version)
+
+__author__ = 'Nikolay Gatilov'
+__copyright__ = 'Nikolay Gatilov'
+__license__ = 'GPL'
+__version__ = '1.0.2026101818'
+__maintainer__ = 'Nikolay Gatilov'
+__email__ = 'eking.work@gmail.com'
+
+DOMAINS = ['example.com', 'example.org', 'example.net', 'mail.ru',
+           'gmail.com', 'yandex.ru', 'list.ru', 'outlook.com']
+STATUSES = [(70, 'sent', '250 2.0.0 Ok: queued as %s'),
+            (20, 'deferred', 'connect to %s[%s]:25: Connection timed out'),
+            (10, 'bounced', 'host %s[%s] said: 550 5.1.1 User unknown')]
+MODES = [('index', True), ('index', False), ('noindex', True),
+         ('noindex', False), ('fulllog', True), ('fulllog', False)]
+
+
+def msgID(i):
+    '''Postfix like queue ID'''
+    return '%010X' % (i * 2654435761 % 0xFFFFFFFFFF)
+
+
+def makeIndex(ids, lines=5):
+    '''OffsetIndex of log file with messages ids, lines per message'''
+    id_seek_d = {}
+    pos = 0
+    for n in range(lines):
+        for mid in ids:
+            if mid not in id_seek_d.keys():
+                id_seek_d[mid] = array('Q')
+            id_seek_d[mid].append(pos)
+            pos += 150
+    return OffsetIndex.fromDict(id_seek_d)
+
+
+def genMessage(rnd, users):
+    '''Return list of log lines (without time and host) of one message'''
+    mid = '%010X' % rnd.getrandbits(40)
+    ip = '10.%d.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255),
+                          rnd.randint(1, 254))
+    pid = rnd.randint(1000, 60000)
+    sender = 'user%d@%s' % (rnd.randint(1, users), rnd.choice(DOMAINS))
+    if rnd.random() < 0.05:
+        sender = ''
+    nrcpt = rnd.randint(1, 3)
+    lines = ['postfix/smtpd[%d]: connect from unknown[%s]' % (pid, ip),
+             'postfix/smtpd[%d]: %s: client=unknown[%s]' % (pid, mid, ip),
+             'postfix/cleanup[%d]: %s: message-id=<%s.%d@%s>' %
+             (pid + 1, mid, mid.lower(), pid, rnd.choice(DOMAINS)),
+             'postfix/qmgr[999]: %s: from=<%s>, size=%d, nrcpt=%d '
+             '(queue active)' % (mid, sender, rnd.randint(500, 200000),
+                                 nrcpt),
+             'postfix/smtpd[%d]: disconnect from unknown[%s]' % (pid, ip)]
+    removed = True
+    for n in range(nrcpt):
+        rcpt = 'rcpt%d@%s' % (rnd.randint(1, users), rnd.choice(DOMAINS))
+        mx = 'mx%d.%s' % (rnd.randint(1, 3), rcpt.split('@')[1])
+        mxip = '192.0.2.%d' % rnd.randint(1, 254)
+        w = rnd.randint(1, 100)
+        for weight, status, reason in STATUSES:
+            w -= weight
+            if w <= 0:
+                break
+        if status == 'sent':
+            reason = reason % ('%010X' % rnd.getrandbits(40))
+        else:
+            reason = reason % (mx, mxip)
+        if status == 'deferred':
+            removed = False
+        lines.append('postfix/smtp[%d]: %s: to=<%s>, relay=%s[%s]:25, '
+                     'delay=%.1f, delays=0.1/0/0.5/0.6, dsn=%s, '
+                     'status=%s (%s)' %
+                     (pid + 2, mid, rcpt, mx, mxip, rnd.random() * 10,
+                      '2.0.0' if status == 'sent' else '4.4.1'
+                      if status == 'deferred' else '5.1.1', status, reason))
+    if removed:
+        lines.append('postfix/qmgr[999]: %s: removed' % mid)
+    return lines
+
+
+def genLogs(log_dir, files=4, messages=20000, size=0, plain=2, users=1000,
+            seed=1):
+    '''Write rotated log files to log_dir: mail.info (the newest),
+       mail.info.1, ..., files from number plain are gzipped, every
+       file is one day of log, messages - number of messages in file
+       or size - size of uncompressed file (bytes, if not 0).
+       Messages are interleaved, about 2% of lines are not from postfix.
+       Return list of dicts {file, messages, lines, bytes}.
+    '''
+    rnd = random.Random(seed)
+    os.makedirs(log_dir, exist_ok=True)
+    now = datetime.datetime.now().replace(microsecond=0)
+    if size:
+        # about 1100 bytes per message
+        messages = max(1, size // 1100)
+    res = []
+    for n in reversed(range(files)):
+        name = 'mail.info' + ('.%d' % n if n else '') + \
+            ('.gz' if n >= plain else '')
+        path = os.path.join(log_dir, name)
+        start = now - datetime.timedelta(days=n + 1)
+        step = 86400.0 / messages
+        f = gzip.open(path, 'wb') if n >= plain else open(path, 'wb')
+        active = []
+        written = 0
+        lines = 0
+        k = 0
+        t = start
+        while active or (size and written < size) or \
+                (not size and k < messages):
+            if (size and written < size) or (not size and k < messages):
+                active.append(genMessage(rnd, users))
+                k += 1
+                t = start + datetime.timedelta(seconds=int(k * step))
+            while active and (len(active) > 20 or
+                              (size and written >= size) or
+                              (not size and k >= messages)):
+                if rnd.random() < 0.02:
+                    line = 'dovecot: imap-login: Login: user=<user%d>' % \
+                        rnd.randint(1, users)
+                else:
+                    msg = rnd.choice(active[:5])
+                    line = msg.pop(0)
+                    if not msg:
+                        active.remove(msg)
+                data = ('%s mx %s\n' % (t.strftime('%b %d %H:%M:%S'),
+                                        line)).encode('utf-8')
+                f.write(data)
+                written += len(data)
+                lines += 1
+        f.close()
+        mtime = t.timestamp()
+        os.utime(path, (mtime, mtime))
+        res.append({'file': name, 'messages': k, 'lines': lines,
+                    'bytes': written})
+    return res
+
+
+def rawSize(path):
+    '''Size of uncompressed file (size of gzip file is from its trailer,
+       modulo 4 GB)'''
+    if path[-3:] != '.gz':
+        return os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.seek(-4, 2)
+        return int.from_bytes(f.read(4), 'little')
+
+
+def peakRSS():
+    '''Peak RSS (MB) of this process and of its children (pool workers)'''
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0)
+
+
+def sampleIDs(path, count):
+    '''Return list of the first count message IDs from log file'''
+    postfixline = re.compile(r'.* postfix.*: (\w+): .*')
+    ids = []
+    seen = set()
+    opener = gzip.open if path[-3:] == '.gz' else open
+    with opener(path, 'rt', errors='replace') as f:
+        for line in f:
+            plr = postfixline.match(line)
+            if plr and plr.group(1) not in seen:
+                seen.add(plr.group(1))
+                ids.append(plr.group(1))
+                if len(ids) >= count:
+                    break
+    return ids
+
+
+def benchCase(log_dir, mode, multiprocess, regs, ids, engine='auto'):
+    '''Parse logs in one mode, return dict with results'''
+    p = Postfix(log_dir=log_dir, multiprocess=multiprocess,
+                noindex=(mode == 'noindex'), engine=engine)
+    t = p.startTiming()
+    files = p.getFiles()
+    p.addTiming('getFiles', t)
+    raw = sum(rawSize(f) for f in files)
+    if mode == 'fulllog':
+        ids = sampleIDs(files[0], ids)
+        t = time.perf_counter()
+        res = p.getPostfixMailLogsByID(ids)
+        found = {'ids': len(res)}
+    else:
+        t = time.perf_counter()
+        res = p.getPostfixMailLogs(regs)
+        found = dict((reg, len(res[reg])) for reg in res.keys())
+    total = time.perf_counter() - t
+    # workers are counted in RUSAGE_CHILDREN after they are joined
+    p.close()
+    rss, rss_children = peakRSS()
+    return {'mode': mode,
+            'multiprocess': multiprocess,
+            'engine': engine,
+            'seconds': round(total, 4),
+            'phases': dict((k, round(v, 4)) for k, v in p.timings.items()),
+            'bytes': raw,
+            'mb_per_second': round(raw / 1048576.0 / max(total, 1e-9), 2),
+            'peak_rss_mb': round(rss, 1),
+            'peak_rss_workers_mb': round(rss_children, 1),
+            'found': found}
+
+
+def benchRun(log_dir, regs, ids, repeat, engine='auto'):
+    '''Run every mode repeat times in new process,
+       return list of the best results'''
+    res = []
+    for mode, multiprocess in MODES:
+        best = None
+        for i in range(repeat):
+            cmd = [sys.executable, os.path.abspath(__file__), 'case',
+                   '--log-dir', log_dir, '--mode', mode, '--ids', str(ids),
+                   '--engine', engine]
+            if not multiprocess:
+                cmd.append('--nomultiproc')
+            for reg in regs:
+                cmd.extend(['--regex', reg])
+            out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True,
+                                 universal_newlines=True).stdout
+            r = json.loads(out)
+            if best is None or r['seconds'] < best['seconds']:
+                best = r
+        res.append(best)
+    return res
+
+
+def benchJoin(files, messages, steps, regs, repeat):
+    '''Join found IDs (1/2**steps ... all of messages) with indexes
+       of files, return list of results'''
+    p = Postfix()
+    ids = [msgID(i) for i in range(messages)]
+    per_file = len(ids) // files
+    idx_l = [('mail.info.%d' % n, makeIndex(ids[n * per_file:
+                                                (n + 1) * per_file]))
+             for n in range(files)]
+    rnd = random.Random(0)
+    res = []
+    for step in range(steps, -1, -1):
+        found = rnd.sample(ids, len(ids) >> step)
+        best = None
+        for i in range(repeat):
+            reg_d = {}
+            for n in range(regs):
+                reg_d['regex%d' % n] = set(found[n::regs])
+            t = time.perf_counter()
+            fs = p.joinIndex(p.invertRegIDs(reg_d), idx_l)
+            t = time.perf_counter() - t
+            if best is None or t < best:
+                best = t
+        offsets = sum(len(i[1]) for i in fs)
+        res.append({'found_ids': len(found),
+                    'offsets': offsets,
+                    'seconds': round(best, 6),
+                    'us_per_id': round(best / max(len(found), 1) * 1e6, 3)})
+    return res
+
+
+if __name__ == "__main__":
+    import argparse
+    opt = argparse.ArgumentParser(description='Benchmarks of postmgr.py')
+    sub = opt.add_subparsers(dest='bench')
+    sub.required = True
+    og = sub.add_parser('gen', help='Write synthetic log files')
+    og.add_argument('--log-dir', dest='log_dir', required=True,
+                    help='Directory for log files (default: %(default)s)')
+    og.add_argument('--files', dest='files', type=int, default=4,
+                    help='Number of log files (default: %(default)s)')
+    og.add_argument('--messages', dest='messages', type=int, default=20000,
+                    help='Number of messages per file (default: %(default)s)')
+    og.add_argument('--size', dest='size', type=int, default=0,
+                    help='Size of uncompressed file (MB), used instead of '
+                         '--messages if not 0 (default: %(default)s)')
+    og.add_argument('--plain', dest='plain', type=int, default=2,
+                    help='Number of uncompressed files, others are gzipped '
+                         '(default: %(default)s)')
+    og.add_argument('--users', dest='users', type=int, default=1000,
+                    help='Number of senders and recipients per domain '
+                         '(default: %(default)s)')
+    og.add_argument('--seed', dest='seed', type=int, default=1,
+                    help='Random seed (default: %(default)s)')
+    for name, text in (('run', 'Parse log files in all modes'),
+                       ('case', 'Parse log files in one mode (used by run)')):
+        orun = sub.add_parser(name, help=text)
+        orun.add_argument('--log-dir', dest='log_dir', required=True,
+                          help='Directory with log files '
+                               '(default: %(default)s)')
+        orun.add_argument('--regex', dest='regex', action='append',
+                          help='Regex to search (default: user1@example.com '
+                               'and rcpt2@gmail.com)')
+        orun.add_argument('--ids', dest='ids', type=int, default=1000,
+                          help='Number of message IDs for fulllog mode '
+                               '(default: %(default)s)')
+        orun.add_argument('--engine', dest='engine', default='auto',
+                          choices=['auto', 'mmap', 'lines'],
+                          help='How to scan uncompressed log files '
+                               '(default: %(default)s)')
+        if name == 'run':
+            orun.add_argument('--repeat', dest='repeat', type=int, default=1,
+                              help='Repeat and take the best time '
+                                   '(default: %(default)s)')
+        else:
+            orun.add_argument('--mode', dest='mode', default='index',
+                              choices=['index', 'noindex', 'fulllog'],
+                              help='Mode (default: %(default)s)')
+            orun.add_argument('--nomultiproc', dest='multiproc',
+                              action='store_false',
+                              help='Do not use multiprocessing '
+                                   '(default: %(default)s)')
+    oj = sub.add_parser('join', help='Join of found IDs with log index')
+    oj.add_argument('--files', dest='files', type=int, default=4,
+                    help='Number of log files (default: %(default)s)')
+    oj.add_argument('--messages', dest='messages', type=int, default=200000,
+                    help='Number of messages in all files '
+                         '(default: %(default)s)')
+    oj.add_argument('--steps', dest='steps', type=int, default=6,
+                    help='Number of times found IDs are halved '
+                         '(default: %(default)s)')
+    oj.add_argument('--regs', dest='regs', type=int, default=2,
+                    help='Number of regex (default: %(default)s)')
+    oj.add_argument('--repeat', dest='repeat', type=int, default=3,
+                    help='Repeat and take the best time '
+                         '(default: %(default)s)')
+    args = opt.parse_args()
+    if args.bench in ('run', 'case') and args.regex is None:
+        args.regex = ['user1@example.com', 'rcpt2@gmail.com']
+    if args.bench == 'gen':
+        res = genLogs(args.log_dir, files=args.files, messages=args.messages,
+                      size=args.size * 1024 * 1024, plain=args.plain,
+                      users=args.users, seed=args.seed)
+    elif args.bench == 'case':
+        print(json.dumps(benchCase(args.log_dir, args.mode, args.multiproc,
+                                   args.regex, args.ids, args.engine)))
+        sys.exit(0)
+    elif args.bench == 'run':
+        res = benchRun(args.log_dir, args.regex, args.ids, args.repeat,
+                       args.engine)
+    elif args.bench == 'join':
+        res = benchJoin(args.files, args.messages, args.steps, args.regs,
+                        args.repeat)
+    print(json.dumps({'bench': args.bench, 'version': postmgr_version,
+                      'results': res}, indent=2))